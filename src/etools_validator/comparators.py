@@ -0,0 +1,108 @@
+import datetime
+from functools import partial
+from weakref import WeakKeyDictionary
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db.models import DateTimeField, Field, FileField, JSONField, TextField
+from django.utils import timezone
+
+# field class -> comparator(field, value1, value2) returning True if equal
+_registry = {}
+# model field -> comparator(value1, value2)
+_resolved = WeakKeyDictionary()
+
+
+def register_comparator(field_class, comparator=None):
+    '''Register the comparator used for fields of field_class and its subclasses,
+    can be used as a decorator. The comparator is called with the model field
+    and the two values and returns True if they are equal.
+    '''
+    if comparator is None:
+        return partial(register_comparator, field_class)
+    from .utils import _clear_field_caches  # field caches hold resolved comparators
+
+    _registry[field_class] = comparator
+    _resolved.clear()
+    _clear_field_caches()
+    return comparator
+
+
+def get_field_comparator(field):
+    '''Return comparator(value1, value2) for the model field,
+    resolved from the registry once per field'''
+    try:
+        return _resolved[field]
+    except KeyError:
+        pass
+    for klass in type(field).__mro__:
+        if klass in _registry:
+            comparator = _resolved[field] = partial(_registry[klass], field)
+            return comparator
+    comparator = _resolved[field] = partial(default_comparison, field)
+    return comparator
+
+
+def default_comparison(field, value1, value2):
+    if value1 is value2 or value1 == value2:
+        return True
+    if type(value1) is type(value2) or value1 is None or value2 is None:
+        return False
+    # same value in different representations, eg. Decimal('1.10'), 1.1 and '1.1'
+    try:
+        return field.to_python(value1) == field.to_python(value2)
+    except (ValidationError, TypeError, ValueError):
+        return False
+
+
+def file_comparison(field, value1, value2):
+    # compare names only, an empty file can have either None or '' as name
+    name1 = getattr(value1, 'name', value1) or None
+    name2 = getattr(value2, 'name', value2) or None
+    return name1 == name2
+
+
+def text_comparison(field, value1, value2):
+    if value1 is value2:
+        return True
+    if isinstance(value1, str) and isinstance(value2, str):
+        # str hashes are cached, different hashes mean different values
+        # without comparing large texts character by character
+        if len(value1) != len(value2) or hash(value1) != hash(value2):
+            return False
+    return value1 == value2
+
+
+def json_comparison(field, value1, value2):
+    if value1 is value2:
+        return True
+    if isinstance(value1, str) and isinstance(value2, str):
+        return text_comparison(field, value1, value2)
+    # isinstance, serializers give OrderedDict or ReturnDict for equal values
+    for container in (dict, list):
+        if isinstance(value1, container) and isinstance(value2, container) and len(value1) != len(value2):
+            return False
+    return value1 == value2
+
+
+def datetime_comparison(field, value1, value2):
+    if value1 is value2 or value1 == value2:
+        return True
+    if isinstance(value1, datetime.datetime) and isinstance(value2, datetime.datetime):
+        return _aware(value1) == _aware(value2)
+    return default_comparison(field, value1, value2)
+
+
+def _aware(value):
+    if settings.USE_TZ and timezone.is_naive(value):
+        return timezone.make_aware(value)
+    return value
+
+
+_registry.update({
+    Field: default_comparison,
+    FileField: file_comparison,
+    TextField: text_comparison,
+    JSONField: json_comparison,
+    DateTimeField: datetime_comparison,
+})
@@ -0,0 +1,95 @@
+import time
+from collections import namedtuple
+from contextlib import contextmanager, ExitStack
+
+from django.db import connections
+from django.dispatch import Signal
+
+# sent after each validation phase and each validation function has run,
+# with arguments: validator, phase, function, duration, queries, db_time
+# function is None when timing a whole phase, durations are in seconds
+validation_timing = Signal()
+
+Timing = namedtuple('Timing', ['validator', 'phase', 'function', 'duration', 'queries', 'db_time'])
+
+
+class _QueryCounter(object):
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries += 1
+            self.db_time += time.perf_counter() - start
+
+
+@contextmanager
+def instrument(validator, phase, function=None):
+    '''Measure wall time, number of queries and time spent in the database
+    for the wrapped block, and send them with the validation_timing signal.
+    Does nothing when no receiver is connected.
+    '''
+    if not validation_timing.has_listeners():
+        yield
+        return
+
+    counter = _QueryCounter()
+    with ExitStack() as stack:
+        for alias in connections:
+            stack.enter_context(connections[alias].execute_wrapper(counter))
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+
+    validation_timing.send(
+        sender=type(validator),
+        validator=validator,
+        phase=phase,
+        function=function,
+        duration=duration,
+        queries=counter.queries,
+        db_time=counter.db_time,
+    )
+
+
+class TimingCollector(object):
+    '''Collect validation timings in memory.
+
+    with TimingCollector() as collector:
+        validator.is_valid
+    collector.timings
+    '''
+    def __init__(self):
+        self.timings = []
+
+    def __call__(self, sender, **kwargs):
+        self.timings.append(Timing(
+            validator=kwargs['validator'],
+            phase=kwargs['phase'],
+            function=kwargs['function'],
+            duration=kwargs['duration'],
+            queries=kwargs['queries'],
+            db_time=kwargs['db_time'],
+        ))
+
+    def connect(self):
+        validation_timing.connect(self, weak=False, dispatch_uid=id(self))
+
+    def disconnect(self):
+        validation_timing.disconnect(dispatch_uid=id(self))
+
+    def __enter__(self):
+        self.connect()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.disconnect()
+
+    def for_phase(self, phase, function=None):
+        return [timing for timing in self.timings if timing.phase == phase and timing.function == function]
@@ -0,0 +1,136 @@
+import json
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from itertools import islice
+
+import django
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.utils.module_loading import import_string
+
+
+def iter_revalidate_slice(model_label, validator_path, start, end, chunk_size, stateless, share_permissions=False):
+    '''Validate the objects with start <= pk < end, end None for no upper
+    bound and start None for all objects, generating json serializable results.
+    '''
+    if not apps.ready:
+        # spawned worker processes start without django being set up
+        django.setup()
+    model = apps.get_model(model_label)
+    validator_class = import_string(validator_path)
+    queryset = model.objects.all()
+    if start is not None:
+        queryset = queryset.filter(pk__gte=start)
+    if end is not None:
+        queryset = queryset.filter(pk__lt=end)
+    for instance, valid, errors in validator_class.validate_many(
+            queryset,
+            chunk_size=chunk_size,
+            share_permissions=share_permissions,
+            stateless=stateless,
+    ):
+        yield {'pk': instance.pk, 'valid': valid, 'errors': errors}
+
+
+def revalidate_slice(*args, **kwargs):
+    '''list of iter_revalidate_slice results, runs inside worker processes'''
+    return list(iter_revalidate_slice(*args, **kwargs))
+
+
+class Command(BaseCommand):
+    help = 'Run validation for all objects of a model and report the results as JSON lines'
+
+    def add_arguments(self, parser):
+        parser.add_argument('model', help='model to revalidate, as app_label.ModelName')
+        parser.add_argument('--validator', required=True, help='dotted path to the CompleteValidation class')
+        parser.add_argument('--workers', type=int, default=1,
+                            help='number of worker processes, 1 runs in the current process')
+        parser.add_argument('--chunk-size', type=int, default=500,
+                            help='number of objects loaded per query')
+        parser.add_argument('--mode', choices=('stateless', 'full'), default='stateless',
+                            help='full mode also runs transition and state validation '
+                                 'and saves auto-transitions')
+        parser.add_argument('--share-permissions', action='store_true',
+                            help='compute permissions once per status, only if they '
+                                 'do not depend on the instance')
+        parser.add_argument('--output', help='file to write the report to, defaults to stdout')
+
+    def handle(self, *args, **options):
+        model_label = options['model']
+        try:
+            model = apps.get_model(model_label)
+        except (LookupError, ValueError):
+            raise CommandError('Unknown model {}'.format(model_label))
+        try:
+            import_string(options['validator'])
+        except ImportError as e:
+            raise CommandError('Unable to import validator: {}'.format(e))
+
+        if options['chunk_size'] < 1:
+            raise CommandError('--chunk-size must be at least 1')
+        workers = max(options['workers'], 1)
+        stateless = options['mode'] == 'stateless'
+        slices = self.get_slices(model, workers, options['chunk_size'])
+        task_args = [
+            (model_label, options['validator'], start, end, options['chunk_size'], stateless,
+             options['share_permissions'])
+            for start, end in slices
+        ]
+
+        output = open(options['output'], 'w') if options['output'] else None
+        total = invalid = 0
+        try:
+            for result in self.run(task_args, workers):
+                total += 1
+                if not result['valid']:
+                    invalid += 1
+                line = json.dumps(result, default=str)
+                if output:
+                    output.write(line + '\n')
+                else:
+                    self.stdout.write(line)
+        finally:
+            if output:
+                output.close()
+
+        self.stderr.write('Validated {} objects, {} invalid'.format(total, invalid))
+
+    def get_slices(self, model, workers, chunk_size):
+        '''(start, end) pk bounds of slices of chunk_size rows, see iter_revalidate_slice'''
+        if workers == 1:
+            return [(None, None)] if model.objects.exists() else []
+        # every chunk_size-th pk, streamed so only the boundaries are kept
+        pks = model.objects.order_by('pk').values_list('pk', flat=True).iterator()
+        starts = list(islice(pks, 0, None, chunk_size))
+        return list(zip(starts, starts[1:] + [None]))
+
+    def run(self, task_args, workers):
+        '''generate the results of the slices, in process for a single worker'''
+        if workers == 1:
+            for args in task_args:
+                yield from iter_revalidate_slice(*args)
+            return
+
+        # connections must not be shared with forked workers,
+        # each worker opens its own
+        connections.close_all()
+        task_args = iter(task_args)
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            # submit slices as others complete, so only a few slice results
+            # are held in memory at a time
+            pending = set()
+            while True:
+                for args in task_args:
+                    pending.add(executor.submit(revalidate_slice, *args))
+                    if len(pending) >= workers * 2:
+                        break
+                if not pending:
+                    return
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    try:
+                        results = future.result()
+                    except Exception as e:
+                        executor.shutdown(cancel_futures=True)
+                        raise CommandError('Revalidation failed: {}'.format(e)) from e
+                    yield from results
@@ -1,11 +1,198 @@
-from django.db.models import ObjectDoesNotExist
+from collections import namedtuple
+
+from django.apps import apps
+from django.core.exceptions import FieldDoesNotExist, ImproperlyConfigured, ValidationError as DjangoValidationError
+from django.db.models import FileField, ForeignObjectRel, ObjectDoesNotExist
 
 from rest_framework.exceptions import ValidationError
+from rest_framework.relations import ManyRelatedField
+from rest_framework.serializers import BaseSerializer
 
 from .parsers import parse_multipart_data
+from .utils import (
+    Changeset,
+    check_rigid_fields_in_db,
+    get_related_checksum,
+    get_related_fingerprints,
+    snapshot_instance,
+)
+
+# a SERIALIZER_MAP entry: the related_model objects of the name relation
+# point back to the instance with their reverse_name field
+RelatedField = namedtuple('RelatedField', ['name', 'related_model', 'reverse_name', 'serializer', 'one_to_one'])
+
+
+def get_related_fields(model, serializer_map, bulk_names=()):
+    '''Return {name: RelatedField} for the SERIALIZER_MAP of a view on model,
+    raising ImproperlyConfigured for names that are not reverse relations
+    and for BULK_RELATED_FIELDS bulk_names that cannot be written in bulk'''
+    related_fields = {}
+    for name, serializer in serializer_map.items():
+        try:
+            field = model._meta.get_field(name)
+        except FieldDoesNotExist:
+            raise ImproperlyConfigured(
+                'SERIALIZER_MAP: {} has no field {}'.format(model._meta.label, name)
+            )
+        if not isinstance(field, ForeignObjectRel) or field.many_to_many:
+            raise ImproperlyConfigured(
+                'SERIALIZER_MAP: {}.{} is not a reverse foreign key '
+                'or one to one relation'.format(model._meta.label, name)
+            )
+        related_fields[name] = RelatedField(
+            name=name,
+            related_model=field.related_model,
+            reverse_name=field.remote_field.name,
+            serializer=serializer,
+            one_to_one=field.one_to_one,
+        )
+    for name in bulk_names:
+        if name not in related_fields:
+            raise ImproperlyConfigured(
+                'BULK_RELATED_FIELDS: {} is not in SERIALIZER_MAP'.format(name)
+            )
+        check_bulk_serializer(model, related_fields[name].serializer())
+    return related_fields
+
+
+def check_bulk_serializer(model, serializer):
+    '''Raise ImproperlyConfigured if the serializer of a BULK_RELATED_FIELDS
+    entry writes many to many or nested fields, model(**data) and bulk_update
+    only save the concrete fields of the related model'''
+    many_to_many = {field.name for field in serializer.Meta.model._meta.many_to_many}
+    for name, field in serializer.fields.items():
+        if field.read_only:
+            continue
+        if field.source in many_to_many or isinstance(field, (ManyRelatedField, BaseSerializer)):
+            raise ImproperlyConfigured(
+                'BULK_RELATED_FIELDS: the serializer of {} writes {}, '
+                'which cannot be saved in bulk'.format(model._meta.label, name)
+            )
+
+
+def _to_pk(model, value):
+    if not value:
+        return None
+    return model._meta.pk.to_python(value)
 
 
 class ValidatorViewMixin:
+    # store <field>_old related snapshots as RelatedFingerprints instead of
+    # lists of instances, rigid checks then compare them as sets
+    FINGERPRINT_RELATED_SNAPSHOTS = False
+    # store <field>_old related snapshots as a RelatedChecksum computed in
+    # the database, falls back to the other modes if the database has no
+    # hash function
+    CHECKSUM_RELATED_SNAPSHOTS = False
+    # snapshot in my_update only the related fields that are not editable
+    # for the instance, see get_related_snapshot_names
+    PERMISSION_RELATED_SNAPSHOTS = False
+    # in my_update, check the fields that are not editable against the
+    # database before saving, see check_rigid_fields_in_db
+    DB_RIGID_FIELDS_CHECK = False
+    # SERIALIZER_MAP entries written with bulk_create and bulk_update,
+    # see _bulk_handle_fields
+    BULK_RELATED_FIELDS = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # model class -> {name: RelatedField}
+        cls._related_fields_cache = {}
+        model = cls._get_view_model()
+        if model is not None and getattr(cls, 'SERIALIZER_MAP', None) and apps.models_ready:
+            # fail on import for a misconfigured SERIALIZER_MAP
+            cls._related_fields_cache[model] = get_related_fields(
+                model, cls.SERIALIZER_MAP, cls.BULK_RELATED_FIELDS
+            )
+
+    @classmethod
+    def _get_view_model(cls):
+        queryset = getattr(cls, 'queryset', None)
+        if queryset is not None:
+            return queryset.model
+        meta = getattr(getattr(cls, 'serializer_class', None), 'Meta', None)
+        return getattr(meta, 'model', None)
+
+    def get_related_field(self, obj, rel_prop_name):
+        '''Return the RelatedField of SERIALIZER_MAP for obj, compiled once per view class and model'''
+        model = obj.__class__
+        try:
+            related_fields = self._related_fields_cache[model]
+        except KeyError:
+            related_fields = self._related_fields_cache[model] = get_related_fields(
+                model, self.SERIALIZER_MAP, self.BULK_RELATED_FIELDS
+            )
+        return related_fields[rel_prop_name]
+
+    def _snapshot_related(self, manager):
+        if self.CHECKSUM_RELATED_SNAPSHOTS:
+            checksum = get_related_checksum(manager.all())
+            if checksum is not None:
+                return checksum
+        if self.FINGERPRINT_RELATED_SNAPSHOTS:
+            return get_related_fingerprints(manager.all())
+        return list(manager.all())
+
+    def get_rigid_field_names(self, instance, data=None):
+        '''Return the set of field names that the permissions of the view
+        validation class mark as not editable in the current status of the
+        instance, and in the status requested by data if given.
+        None if the view has no validation class with permissions.
+        '''
+        if not hasattr(self, 'get_validation_class'):
+            return None
+        validator = self.get_validation_class()(instance, user=self.request.user)
+        instances = [instance]
+        if data and data.get('status') and data['status'] != getattr(instance, 'status', None):
+            requested = snapshot_instance(instance)
+            # bypass the descriptor, fsm fields can be protected
+            requested.__dict__['status'] = data['status']
+            instances.append(requested)
+        rigid = set()
+        for status_instance in instances:
+            permissions = validator.get_permissions(status_instance)
+            if permissions is None:
+                return None
+            rigid.update(f for f, editable in permissions['edit'].items() if editable is False)
+        return rigid
+
+    def get_related_snapshot_names(self, instance, data, names):
+        '''Return the related field names to store a <field>_old snapshot for in
+        my_update, all of them by default.
+        With PERMISSION_RELATED_SNAPSHOTS only the fields that the permissions
+        of the view validation class mark as not editable, in the current
+        status of the instance or in the status requested by data. Related
+        fields without a snapshot are considered unchanged by the rigid checks.
+        '''
+        if not self.PERMISSION_RELATED_SNAPSHOTS:
+            return names
+        rigid = self.get_rigid_field_names(instance, data)
+        if rigid is None:
+            return names
+        return [name for name in names if name in rigid]
+
+    def check_rigid_fields_in_db(self, instance, serializer):
+        '''Check the scalar fields written by serializer that are not editable
+        in the current status against the database, before my_update saves
+        the instance, see utils.check_rigid_fields_in_db
+        '''
+        rigid = self.get_rigid_field_names(instance)
+        if not rigid:
+            return
+        concrete_names = {field.name for field in instance._meta.concrete_fields}
+        fields = [name for name in serializer.validated_data if name in rigid and name in concrete_names]
+        if not fields:
+            return
+        updated = snapshot_instance(instance)
+        for name in fields:
+            setattr(updated, name, serializer.validated_data[name])
+        valid, field = check_rigid_fields_in_db(updated, fields)
+        if not valid:
+            raise ValidationError(['Cannot change fields while in {}: {}'.format(
+                getattr(instance, 'status', None),
+                field,
+            )])
+
     def _parse_data(self, request):
         dt_cp = request.data
         for k in dt_cp:
@@ -19,13 +206,35 @@ class ValidatorViewMixin:
         dt = parse_multipart_data(dt_cp)
         return dt
 
-    def _handle_field(self, obj, field, rel_prop_name, partial, nested_related_names):
-        fieldClass = obj.__class__._meta.get_field(rel_prop_name).related_model
-        reverse_name = obj.__class__._meta.get_field(rel_prop_name).remote_field.name
-        fieldSerializer = self.SERIALIZER_MAP[rel_prop_name]
+    def _get_related_instances(self, obj, items, rel_prop_name):
+        '''Load the existing instances for the items with an id in a single query,
+        raises ValidationError for a malformed id
+        :return: {pk: instance}
+        '''
+        related_model = self.get_related_field(obj, rel_prop_name).related_model
+        pks = set()
+        for item in items:
+            try:
+                pk = _to_pk(related_model, item.get('id', None))
+            except DjangoValidationError as e:
+                raise ValidationError({rel_prop_name: {'id': e.messages}})
+            if pk is not None:
+                pks.add(pk)
+        if not pks:
+            return {}
+        return related_model.objects.in_bulk(pks)
+
+    def _get_field_serializer(self, obj, field, rel_prop_name, partial, nested_related_names, instances=None):
+        '''
+        :param instances: {pk: instance} preloaded by up_related_field, the
+            instance is fetched by id when not given
+        '''
+        related_field = self.get_related_field(obj, rel_prop_name)
+        fieldClass = related_field.related_model
+        fieldSerializer = related_field.serializer
 
         # This is in case we have a OneToOne field
-        field.update({reverse_name: obj.pk})
+        field.update({related_field.reverse_name: obj.pk})
         nested_related_data = {}
         if nested_related_names:
             nested_related_data = {
@@ -34,22 +243,29 @@ class ValidatorViewMixin:
             }
         nested_related_data["request"] = self.request
         if field.get('id', None):
-            try:
-                instance = fieldClass.objects.get(id=field['id'])
-            except fieldClass.DoesNotExist:
-                instance = None
+            if instances is None:
+                try:
+                    instance = fieldClass.objects.get(id=field['id'])
+                except fieldClass.DoesNotExist:
+                    instance = None
+            else:
+                # missing instance, the serializer creates it
+                instance = instances.get(_to_pk(fieldClass, field['id']))
 
-            instance_serializer = fieldSerializer(
+            return fieldSerializer(
                 instance=instance,
                 data=field,
                 partial=partial,
                 context=nested_related_data
             )
-        else:
-            instance_serializer = fieldSerializer(
-                data=field,
-                context=nested_related_data
-            )
+        return fieldSerializer(
+            data=field,
+            context=nested_related_data
+        )
+
+    def _handle_field(self, obj, field, rel_prop_name, partial, nested_related_names, instances=None):
+        instance_serializer = self._get_field_serializer(
+            obj, field, rel_prop_name, partial, nested_related_names, instances=instances)
 
         try:
             instance_serializer.is_valid(raise_exception=True)
@@ -60,6 +276,59 @@ class ValidatorViewMixin:
             e.detail = {rel_prop_name: e.detail}
             raise e
 
+    def _bulk_handle_fields(self, obj, items, rel_prop_name, partial, nested_related_names, instances):
+        '''Validate all the items, then insert the new ones with bulk_create and
+        update the changed fields of the existing ones with bulk_update,
+        one query per set of changed fields.
+        Serializer save() and model save signals are skipped, so only plain
+        model fields are supported. Files are stored and auto_now fields
+        advanced by Field.pre_save, as save() does.
+        '''
+        serializers = [
+            self._get_field_serializer(obj, item, rel_prop_name, partial, nested_related_names, instances=instances)
+            for item in items
+        ]
+        # BULK_RELATED_FIELDS may be overridden per view instance
+        check_bulk_serializer(obj.__class__, serializers[0])
+        errors = [{} if serializer.is_valid() else serializer.errors for serializer in serializers]
+        if any(errors):
+            raise ValidationError({rel_prop_name: errors})
+
+        model = self.get_related_field(obj, rel_prop_name).related_model
+        file_fields = [field for field in model._meta.concrete_fields if isinstance(field, FileField)]
+        auto_now_fields = [field for field in model._meta.concrete_fields if getattr(field, 'auto_now', False)]
+        new_instances = []
+        changed_instances = {}
+        for serializer in serializers:
+            data = serializer.validated_data
+            if serializer.instance is None:
+                serializer.instance = model(**data)
+                new_instances.append(serializer.instance)
+                continue
+            old = snapshot_instance(serializer.instance)
+            for attr, value in data.items():
+                setattr(serializer.instance, attr, value)
+            changed = list(Changeset(serializer.instance, old).get_changed_fields(data.keys()))
+            for field in file_fields:
+                # a new upload can keep the name of the stored file
+                if field.name not in changed and not getattr(serializer.instance, field.attname)._committed:
+                    changed.append(field.name)
+            if not changed:
+                continue
+            for field in file_fields:
+                if field.name in changed:
+                    field.pre_save(serializer.instance, add=False)
+            for field in auto_now_fields:
+                field.pre_save(serializer.instance, add=False)
+                if field.name not in changed:
+                    changed.append(field.name)
+            changed_instances.setdefault(tuple(changed), []).append(serializer.instance)
+
+        if new_instances:
+            model.objects.bulk_create(new_instances)
+        for fields, changed in changed_instances.items():
+            model.objects.bulk_update(changed, fields)
+
     def up_related_field(self, obj, field, rel_prop_name, partial, nested_related_names):
         if not field:
             return
@@ -67,8 +336,12 @@ class ValidatorViewMixin:
         if not isinstance(field, list):
             field = [field]
 
+        instances = self._get_related_instances(obj, field, rel_prop_name)
+        if rel_prop_name in self.BULK_RELATED_FIELDS:
+            self._bulk_handle_fields(obj, field, rel_prop_name, partial, nested_related_names, instances)
+            return
         for item in field:
-            self._handle_field(obj, item, rel_prop_name, partial, nested_related_names)
+            self._handle_field(obj, item, rel_prop_name, partial, nested_related_names, instances=instances)
 
     def my_create(self, request, related_f, nested_related_names=None, **kwargs):
         my_relations = {}
@@ -89,6 +362,28 @@ class ValidatorViewMixin:
 
         return main_serializer
 
+    def _refresh_instance(self, instance, serializer, related_names):
+        '''Reload what the update touched on the instance fetched by my_update,
+        instead of fetching it again: the concrete fields written by the
+        serializer, and the cached related objects of the related fields.
+        '''
+        concrete_names = {field.name for field in instance._meta.concrete_fields}
+        fields = [name for name in serializer.validated_data if name in concrete_names]
+        if fields:
+            instance.refresh_from_db(fields=fields)
+        if related_names:
+            for name in related_names:
+                # one to one relations are cached on the instance
+                instance._state.fields_cache.pop(name, None)
+            # same as UpdateModelMixin, prefetched related sets are stale now
+            instance._prefetched_objects_cache = {}
+
+    def get_query_attribute_names(self):
+        '''names of the attributes the view queryset sets on the instance
+        besides the model fields, annotations and extra selects'''
+        query = self.get_queryset().query
+        return list(query.annotations) + list(query.extra)
+
     def my_update(self, request, related_f, nested_related_names=None, **kwargs):
         partial = kwargs.pop('partial', False)
         data = self._parse_data(request)
@@ -97,17 +392,24 @@ class ValidatorViewMixin:
         for f in related_f:
             my_relations[f] = data.pop(f, [])
 
-        old_instance = self.get_object()
         instance = self.get_object()
+        old_instance = snapshot_instance(instance, self.get_query_attribute_names())
+        snapshot_names = set(self.get_related_snapshot_names(
+            instance,
+            data,
+            list(my_relations) + list(kwargs.get("related_non_serialized_fields", [])),
+        ))
 
         old_related_data = []
         for field in kwargs.get("related_non_serialized_fields", []):
+            if field not in snapshot_names:
+                continue
             rel_field_val = getattr(instance, field, None)
             prop = f"{field}_old"
             if rel_field_val is None:
                 val = None
             else:
-                val = list(rel_field_val.all())
+                val = self._snapshot_related(rel_field_val)
             old_related_data.append((prop, val))
 
         main_serializer = self.get_serializer(
@@ -117,10 +419,15 @@ class ValidatorViewMixin:
         )
         main_serializer.context['skip_global_validator'] = True
         main_serializer.is_valid(raise_exception=True)
+        if self.DB_RIGID_FIELDS_CHECK:
+            # the database still has the old values until the save below
+            self.check_rigid_fields_in_db(instance, main_serializer)
 
         main_object = main_serializer.save()
 
         for k in my_relations.keys():
+            if k not in snapshot_names:
+                continue
             try:
                 rel_field_val = getattr(old_instance, k)
             except ObjectDoesNotExist:
@@ -128,9 +435,9 @@ class ValidatorViewMixin:
             else:
                 prop = '{}_old'.format(k)
 
-                try:
-                    val = list(rel_field_val.all())
-                except AttributeError:
+                if hasattr(rel_field_val, 'all'):
+                    val = self._snapshot_related(rel_field_val)
+                else:
                     # This means OneToOne field
                     val = rel_field_val
 
@@ -142,4 +449,9 @@ class ValidatorViewMixin:
         for field, val in old_related_data:
             setattr(old_instance, field, val)
 
-        return self.get_object(), old_instance, main_serializer
+        self._refresh_instance(
+            main_object,
+            main_serializer,
+            list(my_relations) + list(kwargs.get("related_non_serialized_fields", [])),
+        )
+        return main_object, old_instance, main_serializer
@@ -0,0 +1,99 @@
+import copy
+
+from django.db.models.base import DEFERRED
+from django.db.models.fields.files import FieldFile
+
+from .comparators import get_field_comparator
+
+
+def _initial_value(value):
+    if isinstance(value, FieldFile):
+        return value.name
+    if isinstance(value, (dict, list)):
+        # json values can be changed in place
+        return copy.deepcopy(value)
+    return value
+
+
+class ChangeTrackingMixin(object):
+    '''Model mixin recording the concrete field values loaded from the database.
+
+    The changes and the old version of an instance are then available without
+    fetching the instance again, get_old_instance() can be given to
+    CompleteValidation and to the rigid and editable checks as old instance.
+    Initial values are recorded again after save.
+    '''
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance.reset_initial_values()
+        return instance
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None:
+            update_fields = [self._meta.get_field(name).attname for name in update_fields]
+        self.reset_initial_values(update_fields)
+
+    def reset_initial_values(self, attnames=None):
+        '''record the current values as initial values
+        :param attnames: only these, all loaded concrete fields by default
+        '''
+        if attnames is None or not hasattr(self, '_initial_values'):
+            self._initial_values = {}
+        if attnames is None:
+            attnames = [field.attname for field in self._meta.concrete_fields]
+        for attname in attnames:
+            if attname in self.__dict__:
+                self._initial_values[attname] = _initial_value(self.__dict__[attname])
+
+    def has_initial_values(self):
+        return getattr(self, '_initial_values', None) is not None
+
+    def changed_fields(self):
+        '''
+        :return: list of names of the concrete fields changed since the instance
+            was loaded or saved, all the fields for an instance not loaded yet
+        '''
+        concrete_fields = self._meta.concrete_fields
+        if not self.has_initial_values():
+            return [field.name for field in concrete_fields]
+        changed = []
+        for field in concrete_fields:
+            try:
+                initial = self._initial_values[field.attname]
+                value = self.__dict__[field.attname]
+            except KeyError:
+                # deferred field, not loaded so not changed
+                continue
+            if not get_field_comparator(field)(value, initial):
+                changed.append(field.name)
+        return changed
+
+    def get_old_instance(self):
+        '''Return an instance with the initial values, built without a query.
+        Related objects cached for unchanged foreign keys and prefetched
+        objects are shared with this instance, fields that were not loaded
+        are deferred. None if the instance was not loaded from the database.
+        '''
+        if not self.has_initial_values():
+            return None
+        model = type(self)
+        concrete_fields = self._meta.concrete_fields
+        old = model.from_db(
+            self._state.db,
+            [field.attname for field in concrete_fields],
+            [_initial_value(self._initial_values.get(field.attname, DEFERRED)) for field in concrete_fields],
+        )
+        for field in concrete_fields:
+            if not field.is_relation:
+                continue
+            # related objects are cached by field name
+            unchanged = self.__dict__.get(field.attname) == self._initial_values.get(field.attname, DEFERRED)
+            if unchanged and field.name in self._state.fields_cache:
+                old._state.fields_cache[field.name] = self._state.fields_cache[field.name]
+        if hasattr(self, '_prefetched_objects_cache'):
+            old._prefetched_objects_cache = dict(self._prefetched_objects_cache)
+        return old
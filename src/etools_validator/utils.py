@@ -1,8 +1,73 @@
+import copy
+import json
+import zlib
+from collections import namedtuple
 from itertools import chain
+from operator import attrgetter
+from weakref import WeakKeyDictionary
 
 from django.contrib.contenttypes.fields import GenericForeignKey
-from django.db.models import Model, ObjectDoesNotExist
+from django.db import connections
+from django.db.models import (
+    BigIntegerField,
+    BooleanField,
+    Count,
+    Exists,
+    ExpressionWrapper,
+    F,
+    FileField,
+    Func,
+    Model,
+    ObjectDoesNotExist,
+    OuterRef,
+    Q,
+    Sum,
+    TextField,
+    Value,
+)
 from django.db.models.fields.files import FieldFile
+from django.db.models.functions import Cast, Coalesce, Concat
+from django.db.models.signals import class_prepared
+
+from .comparators import get_field_comparator
+
+# model class -> tuple of field names
+_field_names_cache = WeakKeyDictionary()
+# model class -> tuple of (field name, comparison function)
+_rigid_comparators_cache = WeakKeyDictionary()
+# model class -> function returning the tuple of concrete values
+_concrete_values_cache = WeakKeyDictionary()
+# model class -> {accessor name: Relation}
+_relations_cache = WeakKeyDictionary()
+# model class -> {field name or attname: (kind, attname, comparator)}
+_changeset_fields_cache = WeakKeyDictionary()
+
+# a relation as seen from a model: objects of related_model with
+# lookup=OuterRef(outer_field) are related to the outer object
+Relation = namedtuple('Relation', ['related_model', 'lookup', 'outer_field', 'multiple'])
+
+
+def _clear_field_caches(**kwargs):
+    # a newly registered model can add reverse relations to existing ones
+    _field_names_cache.clear()
+    _rigid_comparators_cache.clear()
+    _concrete_values_cache.clear()
+    _relations_cache.clear()
+    _changeset_fields_cache.clear()
+
+
+class_prepared.connect(_clear_field_caches)
+
+
+def _model_class(model):
+    return model if isinstance(model, type) else type(model)
+
+
+def _get_fields(model):
+    return [
+        field for field in model._meta.get_fields()
+        if not (field.many_to_one and field.related_model is None) and not isinstance(field, GenericForeignKey)
+    ]
 
 
 def get_all_field_names(model):
@@ -15,38 +80,102 @@ def get_all_field_names(model):
     https://github.com/django/django/blob/stable/1.7.x/django/db/models/options.py#L422
     https://docs.djangoproject.com/en/1.10/ref/models/meta/#migrating-from-the-old-api
     '''
-    return list(set(chain.from_iterable(
-        (field.name, field.attname) if hasattr(field, 'attname') else (field.name, )
-        for field in model._meta.get_fields()
-        if not (field.many_to_one and field.related_model is None) and not isinstance(field, GenericForeignKey)
-    )))
+    model = _model_class(model)
+    try:
+        field_names = _field_names_cache[model]
+    except KeyError:
+        field_names = _field_names_cache[model] = tuple(set(chain.from_iterable(
+            (field.name, field.attname) if hasattr(field, 'attname') else (field.name, )
+            for field in _get_fields(model)
+        )))
+    return list(field_names)
 
 
 def check_editable_fields(obj, fields):
     if not getattr(obj, 'old_instance', None):
         return False, fields
+    changeset = get_changeset(obj)
     for field in fields:
-        old_instance = obj.old_instance
-        if getattr(obj, field) != getattr(old_instance, field):
+        if changeset.is_concrete(field):
+            changed = changeset.has_changed(field)
+        else:
+            old_instance = obj.old_instance
+            changed = getattr(obj, field) != getattr(old_instance, field)
+        if changed:
             return False, field
     return True, None
 
 
+def get_relations(model):
+    '''Return {accessor name: Relation} for the reverse relations and many to
+    many fields of the model, computed once per model class'''
+    model = _model_class(model)
+    try:
+        return _relations_cache[model]
+    except KeyError:
+        pass
+    relations = {}
+    for field in model._meta.get_fields():
+        if field.auto_created and not field.concrete and field.is_relation:
+            # reverse relation
+            accessor = field.get_accessor_name()
+            if not accessor:
+                continue
+            if field.many_to_many:
+                outer_field = 'pk'
+            else:
+                outer_field = field.field.target_field.attname
+            relations[accessor] = Relation(field.related_model, field.field.name, outer_field, not field.one_to_one)
+        elif field.many_to_many and not field.auto_created and hasattr(field, 'related_query_name'):
+            relations[field.name] = Relation(field.related_model, field.related_query_name(), 'pk', True)
+    _relations_cache[model] = relations
+    return relations
+
+
+def _relation_exists(relation):
+    return Exists(relation.related_model._default_manager.filter(
+        **{relation.lookup: OuterRef(relation.outer_field)}
+    ))
+
+
+def _has_required_value(obj, f_name):
+    field = getattr(obj, f_name)
+    if hasattr(field, 'filter'):
+        return field.filter().exists()
+    if isinstance(field, FieldFile):
+        return bool(getattr(field, 'name', None))
+    return field is not None
+
+
 def check_required_fields(obj, fields):
+    '''Related fields to many objects are checked with a single query,
+    other fields in memory'''
+    related_exists = {}
+    if obj.pk is not None:
+        relations = get_relations(obj)
+        subqueries = {
+            '_required_{}'.format(f_name): _relation_exists(relations[f_name])
+            for f_name in fields
+            if f_name in relations and relations[f_name].multiple
+        }
+        if subqueries:
+            values = type(obj)._base_manager.filter(pk=obj.pk).annotate(
+                **subqueries
+            ).values(*subqueries).first() or {}
+            related_exists = {
+                alias[len('_required_'):]: bool(value) for alias, value in values.items()
+            }
+
     error_fields = []
     for f_name in fields:
-        try:
-            field = getattr(obj, f_name)
-        except ObjectDoesNotExist:
-            return False, f_name
-        try:
-            response = field.filter().count() > 0
-        except AttributeError:
-            if isinstance(field, FieldFile):
-                response = getattr(field, 'name', None) or False
-            else:
-                response = field is not None
-        if response is False:
+        if f_name in related_exists:
+            response = related_exists[f_name]
+        else:
+            try:
+                response = _has_required_value(obj, f_name)
+            except ObjectDoesNotExist:
+                return False, f_name
+        if not response:
             error_fields.append(f_name)
 
     if error_fields:
@@ -54,6 +183,45 @@ def check_required_fields(obj, fields):
     return True, None
 
 
+def get_missing_required_fields(queryset, fields):
+    '''Return {pk: [missing field names]} for the objects in queryset that
+    miss any of the required fields.
+    Relations are checked with Exists subqueries in the query loading the
+    objects, foreign keys by id and other fields in memory.
+    '''
+    model = queryset.model
+    relations = get_relations(model)
+    foreign_keys = {
+        field.name: field.attname
+        for field in model._meta.concrete_fields
+        if field.is_relation
+    }
+    subqueries = {
+        '_required_{}'.format(f_name): _relation_exists(relations[f_name])
+        for f_name in fields
+        if f_name in relations
+    }
+
+    missing = {}
+    for obj in queryset.annotate(**subqueries):
+        error_fields = []
+        for f_name in fields:
+            if f_name in relations:
+                response = getattr(obj, '_required_{}'.format(f_name))
+            elif f_name in foreign_keys:
+                response = getattr(obj, foreign_keys[f_name]) is not None
+            else:
+                try:
+                    response = _has_required_value(obj, f_name)
+                except ObjectDoesNotExist:
+                    response = False
+            if not response:
+                error_fields.append(f_name)
+        if error_fields:
+            missing[obj.pk] = error_fields
+    return missing
+
+
 def field_comparison(f1, f2):
     if isinstance(f1, FieldFile):
         new_file = getattr(f1, 'name', None)
@@ -65,14 +233,79 @@ def field_comparison(f1, f2):
     return True
 
 
-def check_rigid_model_instance(old_obj, new_obj):
+def get_rigid_comparators(model):
+    '''Return a tuple of (field name, comparison function) for all the
+    field names of the model, computed once per model class.
+    Non relational concrete fields use the comparator registered for their field type.'''
+    model = _model_class(model)
+    try:
+        return _rigid_comparators_cache[model]
+    except KeyError:
+        pass
+    fields = {}
+    for field in _get_fields(model):
+        fields[field.name] = field
+        if hasattr(field, 'attname'):
+            fields[field.attname] = field
+    comparators = _rigid_comparators_cache[model] = tuple(
+        (name, _rigid_comparator(fields[name]))
+        for name in get_all_field_names(model)
+    )
+    return comparators
+
+
+def _rigid_comparator(field):
+    if getattr(field, 'concrete', False) and not field.is_relation:
+        return get_field_comparator(field)
+    return field_comparison
+
+
+def get_concrete_values_getter(model):
+    '''Return a function that returns the tuple of concrete column values
+    of an instance of the model. Values are read by attname, so foreign
+    keys are compared by id without fetching the related object.
+    '''
+    model = _model_class(model)
+    try:
+        return _concrete_values_cache[model]
+    except KeyError:
+        pass
+    attnames = [field.attname for field in model._meta.concrete_fields]
+    getter = attrgetter(*attnames)
+    if len(attnames) == 1:
+        single_getter = getter
+
+        def getter(obj):
+            return (single_getter(obj), )
+    _concrete_values_cache[model] = getter
+    return getter
+
+
+def check_rigid_model_instance(old_obj, new_obj, concrete_only=False, deep_fields=()):
+    '''
+    :param concrete_only: compare only the concrete columns, so that no
+        related objects are loaded
+    :param deep_fields: with concrete_only, names of other fields
+        (reverse relations, one to one accessors) that are compared as well
+    '''
     if not isinstance(old_obj, Model) or not isinstance(new_obj, Model):
         # one of instances can be None, in this case we don't need to check all fields
         return old_obj == new_obj
 
-    field_names = get_all_field_names(old_obj)
+    if concrete_only:
+        if type(old_obj) is not type(new_obj):
+            return False
+        get_values = get_concrete_values_getter(old_obj)
+        if get_values(old_obj) != get_values(new_obj):
+            return False
+        if not deep_fields:
+            return True
+        comparators = dict(get_rigid_comparators(old_obj))
+        comparators = [(field, comparators[field]) for field in deep_fields]
+    else:
+        comparators = get_rigid_comparators(old_obj)
 
-    for field in field_names:
+    for field, comparator in comparators:
         try:
             new_value = getattr(old_obj, field, None)
         except ObjectDoesNotExist:
@@ -81,7 +314,7 @@ def check_rigid_model_instance(old_obj, new_obj):
             old_value = getattr(new_obj, field, None)
         except ObjectDoesNotExist:
             old_value = None
-        if not field_comparison(new_value, old_value):
+        if not comparator(new_value, old_value):
             return False
 
         # there is no check for instance class so we don't go deeper than 1 level
@@ -89,12 +322,105 @@ def check_rigid_model_instance(old_obj, new_obj):
     return True
 
 
-def check_rigid_related(obj, related):
-    current_related = list(getattr(obj, related).filter())
+class RelatedFingerprints(frozenset):
+    '''Compact snapshot of related rows, a set of (pk, hash of the concrete values)'''
+
+
+def get_related_fingerprints(queryset):
+    '''Return the fingerprints of the rows in queryset with a single query.
+    Hashes are only comparable within the same process.
+    '''
+    attnames = [field.attname for field in queryset.model._meta.concrete_fields]
+    return RelatedFingerprints(
+        (row[0], _row_hash(row[1:])) for row in queryset.values_list('pk', *attnames)
+    )
+
+
+def _row_hash(values):
+    try:
+        return hash(values)
+    except TypeError:
+        # json and array values are dicts and lists
+        return hash(json.dumps(values, sort_keys=True, default=str))
+
+
+class RelatedChecksum(namedtuple('RelatedChecksum', ['count', 'total'])):
+    '''Order independent checksum of related rows, computed in the database'''
+
+
+class RowHash(Func):
+    '''32 bit hash of a text expression'''
+    # user defined function on sqlite, see register_sqlite_row_hash
+    function = 'ETOOLS_ROW_HASH'
+    arity = 1
+    output_field = BigIntegerField()
+
+    def as_postgresql(self, compiler, connection, **extra_context):
+        return self.as_sql(
+            compiler,
+            connection,
+            template="('x' || substr(md5(%(expressions)s), 1, 8))::bit(32)::bigint",
+            **extra_context
+        )
+
+    def as_mysql(self, compiler, connection, **extra_context):
+        return self.as_sql(
+            compiler,
+            connection,
+            template="CONV(SUBSTRING(MD5(%(expressions)s), 1, 8), 16, 10)",
+            **extra_context
+        )
+
+
+def _sqlite_row_hash(value):
+    if value is None:
+        return None
+    return zlib.crc32(value.encode('utf-8'))
+
+
+def register_sqlite_row_hash(sqlite_connection):
+    sqlite_connection.create_function(RowHash.function, 1, _sqlite_row_hash, deterministic=True)
+
+
+def get_related_checksum(queryset):
+    '''Return the RelatedChecksum of the rows in queryset with a single
+    aggregate query, or None if the database has no hash function.
+    '''
+    connection = connections[queryset.db]
+    if connection.vendor == 'sqlite':
+        connection.ensure_connection()
+        register_sqlite_row_hash(connection.connection)
+    elif connection.vendor not in ('postgresql', 'mysql'):
+        return None
+
+    parts = [Value('')]
+    for field in queryset.model._meta.concrete_fields:
+        parts += [
+            Coalesce(Cast(F(field.attname), TextField()), Value('\\N')),
+            Value('|'),
+        ]
+    result = queryset.order_by().aggregate(
+        count=Count('pk'),
+        total=Sum(RowHash(Concat(*parts, output_field=TextField()))),
+    )
+    return RelatedChecksum(result['count'], int(result['total'] or 0))
+
+
+def check_rigid_related(obj, related, concrete_only=False, deep_fields=()):
     old_related = getattr(obj.old_instance, '{}_old'.format(related), None)
     if old_related is None:
         # if old related was not set as an attribute on the object, assuming no changes
         return True
+    return _related_matches(getattr(obj, related), old_related, concrete_only, deep_fields)
+
+
+def _related_matches(manager, old_related, concrete_only=False, deep_fields=()):
+    if isinstance(old_related, RelatedFingerprints):
+        return get_related_fingerprints(manager.all()) == old_related
+    if isinstance(old_related, RelatedChecksum):
+        return get_related_checksum(manager.all()) == old_related
+
+    current_related = list(manager.filter())
     if len(current_related) != len(old_related):
         return False
     if len(current_related) == 0:
@@ -105,17 +431,28 @@ def check_rigid_related(obj, related):
     comparison_map = zip(current_related, old_related)
     # check if any field on the related model was changed
     for old_obj, new_obj in comparison_map:
-        if not check_rigid_model_instance(old_obj, new_obj):
+        if not check_rigid_model_instance(old_obj, new_obj, concrete_only, deep_fields):
             return False
     return True
 
 
-def check_rigid_fields(obj, fields, old_instance=None, related=False):
+def check_rigid_fields(obj, fields, old_instance=None, related=False, concrete_only=False, deep_fields=()):
+    '''
+    :param concrete_only: compare related instances by their concrete
+        columns only, see check_rigid_model_instance
+    :param deep_fields: passed to check_rigid_model_instance
+    '''
     if not old_instance and not getattr(obj, 'old_instance', None):
         # since no old version of the object was passed in, we assume there were no changes
         return True, None
+    old_instance = old_instance or obj.old_instance
+    changeset = get_changeset(obj, old_instance)
     for f_name in fields:
-        old_instance = old_instance or obj.old_instance
+        if changeset.is_concrete(f_name):
+            # foreign keys are compared by id
+            if changeset.has_changed(f_name):
+                return False, f_name
+            continue
         try:
             new_field = getattr(obj, f_name, None)
         except ObjectDoesNotExist:
@@ -128,11 +465,11 @@ def check_rigid_fields(obj, fields, old_instance=None, related=False):
         if hasattr(new_field, 'all'):
             # this could be a related field, unfortunately i can't figure out a isinstance check
             if related:
-                if not check_rigid_related(obj, f_name):
+                if not check_rigid_related(obj, f_name, concrete_only, deep_fields):
                     return False, f_name
 
         elif isinstance(old_field, Model) or isinstance(new_field, Model):
-            if not check_rigid_model_instance(old_field, new_field):
+            if not check_rigid_model_instance(old_field, new_field, concrete_only, deep_fields):
                 return False, f_name
 
         elif not field_comparison(new_field, old_field):
@@ -141,6 +478,193 @@ def check_rigid_fields(obj, fields, old_instance=None, related=False):
     return True, None
 
 
+def check_rigid_fields_in_db(obj, fields):
+    '''Check that scalar rigid fields of obj still have the values stored in
+    the database, without loading the old instance.
+    A single exists() query is run when nothing changed, and one more to
+    find the changed field otherwise.
+    Only concrete, non many to many, fields are supported, foreign keys
+    are compared by id.
+    It must run before obj is saved, afterwards the database has the new
+    values and every field matches. In ValidatorViewMixin.my_update, where
+    the instance is saved before CompleteValidation runs, enable
+    DB_RIGID_FIELDS_CHECK instead of calling it from the validator.
+    '''
+    if obj.pk is None or not fields:
+        # nothing stored yet to compare to, same as no old_instance
+        return True, None
+
+    model = type(obj)
+    lookups = {}
+    for f_name in fields:
+        field = model._meta.get_field(f_name)
+        if not getattr(field, 'concrete', False) or field.many_to_many:
+            raise ValueError('{} is not a scalar field of {}'.format(f_name, model.__name__))
+        value = getattr(obj, field.attname)
+        if isinstance(value, FieldFile):
+            value = value.name
+        lookups[f_name] = Q(**{field.attname: value})
+
+    queryset = model._base_manager.filter(pk=obj.pk)
+    if queryset.filter(*lookups.values()).exists():
+        return True, None
+
+    matches = queryset.annotate(**{
+        '_rigid_{}'.format(f_name): ExpressionWrapper(lookup, output_field=BooleanField())
+        for f_name, lookup in lookups.items()
+    }).values_list(*['_rigid_{}'.format(f_name) for f_name in lookups]).first()
+    if matches is None:
+        # the row does not exist (anymore), nothing to compare to
+        return True, None
+    for f_name, match in zip(lookups, matches):
+        if not match:
+            return False, f_name
+    return True, None
+
+
+def _get_changeset_fields(model):
+    model = _model_class(model)
+    try:
+        return _changeset_fields_cache[model]
+    except KeyError:
+        pass
+    fields = {}
+    for field in model._meta.concrete_fields:
+        if isinstance(field, FileField):
+            kind = Changeset.FILE
+        elif field.is_relation:
+            kind = Changeset.FOREIGN_KEY
+        else:
+            kind = Changeset.SCALAR
+        fields[field.name] = fields[field.attname] = (kind, field.attname, get_field_comparator(field))
+    for accessor, relation in get_relations(model).items():
+        kind = Changeset.RELATED if relation.multiple else Changeset.ONE_TO_ONE
+        fields[accessor] = (kind, accessor, None)
+    _changeset_fields_cache[model] = fields
+    return fields
+
+
+class Changeset(object):
+    '''Changes between a model instance and its old version.
+    Each field is compared on first use only, so repeated checks on the same
+    field during a validation run are a dictionary lookup.
+    Scalar values and files are compared with the comparator registered for
+    the field type, foreign keys by id,
+    related sets against the <field>_old snapshot on the old instance (no
+    snapshot means no changes) and one to one relations by instance.
+    '''
+    SCALAR = 'scalar'
+    FILE = 'file'
+    FOREIGN_KEY = 'foreign_key'
+    RELATED = 'related'
+    ONE_TO_ONE = 'one_to_one'
+
+    def __init__(self, new, old):
+        self.new = new
+        self.old = old
+        self._fields = _get_changeset_fields(new)
+        self._changes = {}
+
+    def is_concrete(self, f_name):
+        return self.kind(f_name) in (self.SCALAR, self.FILE, self.FOREIGN_KEY)
+
+    def kind(self, f_name):
+        return self._fields.get(f_name, (None, None, None))[0]
+
+    def has_changed(self, f_name):
+        try:
+            return self._changes[f_name]
+        except KeyError:
+            changed = self._changes[f_name] = self._compare(f_name)
+            return changed
+
+    __contains__ = has_changed
+
+    def get_changed_fields(self, fields=None):
+        '''
+        :param fields: names to check, all concrete fields by default
+        :return: list of the changed field names
+        '''
+        if fields is None:
+            fields = [field.name for field in type(self.new)._meta.concrete_fields]
+        return [f_name for f_name in fields if self.has_changed(f_name)]
+
+    def clear(self):
+        '''forget the compared values, after new was changed'''
+        self._changes.clear()
+
+    def _compare(self, f_name):
+        if self.old is None:
+            return True
+        kind, attname, comparator = self._fields.get(f_name, (None, f_name, None))
+        if kind in (self.SCALAR, self.FILE):
+            return not comparator(getattr(self.new, attname), getattr(self.old, attname))
+        if kind == self.FOREIGN_KEY:
+            return getattr(self.new, attname) != getattr(self.old, attname)
+        if kind == self.RELATED:
+            old_related = getattr(self.old, '{}_old'.format(f_name), None)
+            if old_related is None:
+                return False
+            return not _related_matches(getattr(self.new, f_name), old_related)
+        try:
+            new_value = getattr(self.new, f_name, None)
+        except ObjectDoesNotExist:
+            new_value = None
+        try:
+            old_value = getattr(self.old, f_name, None)
+        except ObjectDoesNotExist:
+            old_value = None
+        if isinstance(new_value, Model) or isinstance(old_value, Model):
+            return not check_rigid_model_instance(old_value, new_value)
+        return not field_comparison(new_value, old_value)
+
+
+def get_changeset(obj, old_instance=None):
+    '''Return the Changeset between obj and old_instance, obj.old_instance by
+    default, reusing the one attached to obj by the validation run'''
+    old_instance = old_instance or getattr(obj, 'old_instance', None)
+    changeset = getattr(obj, '_changeset', None)
+    if changeset is None or changeset.new is not obj or changeset.old is not old_instance:
+        changeset = Changeset(obj, old_instance)
+    return changeset
+
+
+def snapshot_instance(obj, attributes=()):
+    '''Return a lightweight copy of a model instance, a replacement for
+    copy.deepcopy(obj) that does not query the database.
+    Only concrete field values are copied. Related object and prefetch
+    caches are shallow copied, so the cached objects are shared with the
+    original while writing a relation on either side does not affect the other.
+    :param attributes: names of other attributes to copy when set on obj,
+        eg. queryset annotations
+    '''
+    model = type(obj)
+    snapshot = model.__new__(model)
+    snapshot._state = copy.copy(obj._state)
+    snapshot._state.fields_cache = dict(obj._state.fields_cache)
+    if hasattr(obj, '_prefetched_objects_cache'):
+        snapshot._prefetched_objects_cache = dict(obj._prefetched_objects_cache)
+
+    for field in model._meta.concrete_fields:
+        try:
+            value = obj.__dict__[field.attname]
+        except KeyError:
+            # deferred field, left to be loaded on access
+            continue
+        if isinstance(value, FieldFile):
+            # bind file to the snapshot, otherwise it points back to obj
+            value = copy.copy(value)
+            value.instance = snapshot
+        elif isinstance(value, (dict, list)):
+            # json values can be changed in place
+            value = copy.deepcopy(value)
+        snapshot.__dict__[field.attname] = value
+    for name in attributes:
+        if name in obj.__dict__:
+            snapshot.__dict__[name] = obj.__dict__[name]
+    return snapshot
+
+
 def update_object(obj, kwdict):
     for k, v in kwdict.items():
         if isinstance(v, list):
@@ -1,19 +1,175 @@
-import copy
+import hashlib
 import logging
+from weakref import WeakKeyDictionary
 
 from django.apps import apps
+from django.core.cache import caches
 from django.utils.functional import cached_property
 
-from django_fsm import can_proceed, get_all_FIELD_transitions, has_transition_perm
+from asgiref.sync import sync_to_async
+from django_fsm import can_proceed, has_transition_perm
 
 from .decorators import error_data, state_error_data, transition_error_data
-from .utils import update_object
+from .instrumentation import instrument
+from .tracking import ChangeTrackingMixin
+from .utils import Changeset, snapshot_instance, update_object
 
 logger = logging.getLogger(__name__)
 
+# model class -> {(source, target): transition method name}
+_fsm_transition_index = WeakKeyDictionary()
+
+
+def get_fsm_transition_index(model):
+    '''Return a mapping of (source, target) to the transition method name
+    for the transitions defined on the status field of the model.
+    The index is built on first use and cached per model class, a
+    re-created model class gets its own index.
+    '''
+    try:
+        return _fsm_transition_index[model]
+    except KeyError:
+        pass
+
+    index = {}
+    for transition in model._meta.get_field('status').get_all_transitions(model):
+        targets = transition.target
+        if not isinstance(targets, (list, tuple, set)):
+            targets = [targets]
+        for target in targets:
+            # first defined transition wins, same as the linear scan did
+            index.setdefault(
+                (transition.source, target),
+                transition.method.__name__
+            )
+    _fsm_transition_index[model] = index
+    return index
+
+
+def _function_name(function):
+    return getattr(function, '__name__', repr(function))
+
+
+class ModelPlan(object):
+    '''Model dependent part of a validation plan: status choices,
+    auto-transition candidates and side effects per status.
+    '''
+    def __init__(self, model):
+        self.status_choices = frozenset(
+            choice[0] for choice in model._meta.get_field('status').choices
+        )
+        # ptt: Potential Transition To
+        self.auto_transitions = {
+            status: tuple(ptt for ptt in potential if ptt in self.status_choices)
+            for status, potential in getattr(model, 'AUTO_TRANSITIONS', {}).items()
+        }
+        self.side_effects = {
+            status: tuple(functions)
+            for status, functions in getattr(model, 'TRANSITION_SIDE_EFFECTS', {}).items()
+        }
+
+
+class ValidationPlan(object):
+    '''Everything a validator needs that only depends on its class,
+    compiled once per CompleteValidation subclass so that validation
+    runs only execute.
+    '''
+    def __init__(self, validator_class):
+        self.basic_validations = tuple(getattr(validator_class, 'BASIC_VALIDATIONS', []))
+        # (function, wrapped function) pairs
+        self.wrapped_basic_validations = tuple(
+            (function, error_data(function)) for function in self.basic_validations
+        )
+        # status -> state_<status>_valid method name, resolved on the
+        # validator at call time so instance overrides and patches apply
+        self.state_validators = {}
+        for name in dir(validator_class):
+            if name.startswith('state_') and name.endswith('_valid') and len(name) > 12:
+                self.state_validators[name[6:-6]] = name
+        self._model_plans = WeakKeyDictionary()
+
+    def get_state_validator_name(self, status):
+        try:
+            return self.state_validators[status]
+        except KeyError:
+            # may still be set on the instance
+            return 'state_{}_valid'.format(status)
+
+    def get_basic_validations(self, validations):
+        if tuple(validations) == self.basic_validations:
+            return self.wrapped_basic_validations
+        # overridden on the instance or after the class was compiled
+        return tuple((function, error_data(function)) for function in validations)
+
+    def get_model_plan(self, model):
+        try:
+            return self._model_plans[model]
+        except KeyError:
+            model_plan = self._model_plans[model] = ModelPlan(model)
+            return model_plan
+
 
 class CompleteValidation(object):
     PERMISSIONS_CLASS = None
+    # alias of the django cache used to share permissions across requests,
+    # only enable it if permissions depend on model, status and user role
+    # alone, not on the instance itself
+    PERMISSIONS_CACHE = None
+    PERMISSIONS_CACHE_TIMEOUT = 300
+    # bump when the permission structure changes to invalidate cached values
+    PERMISSIONS_CACHE_VERSION = 1
+    # when validating a dict with an id, fetch the instance once and
+    # derive the new instance as an in-memory clone
+    SINGLE_FETCH = False
+    # when validating a model instance using ChangeTrackingMixin without old,
+    # validate against the old instance rebuilt from its initial values
+    TRACKED_OLD_INSTANCE = False
+    # relations loaded up front when validating querysets with validate_many
+    SELECT_RELATED = ()
+    PREFETCH_RELATED = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._validation_plan = ValidationPlan(cls)
+
+    @classmethod
+    def get_validation_plan(cls):
+        plan = cls.__dict__.get('_validation_plan')
+        if plan is None:
+            plan = cls._validation_plan = ValidationPlan(cls)
+        return plan
+
+    @classmethod
+    def validate_many(cls, queryset, user=None, chunk_size=500, share_permissions=False, **kwargs):
+        '''
+        validate every object in queryset, loading the objects in chunks
+        of chunk_size with the relations declared in SELECT_RELATED and
+        PREFETCH_RELATED so queries are issued per chunk not per object
+        :param share_permissions: reuse permissions computed for a status
+            across the batch, only enable if PERMISSIONS_CLASS does not
+            depend on the instance
+        :return: generator of (instance, is_valid, errors)
+        '''
+        queryset = queryset.order_by('pk')
+        if cls.SELECT_RELATED:
+            queryset = queryset.select_related(*cls.SELECT_RELATED)
+        if cls.PREFETCH_RELATED:
+            queryset = queryset.prefetch_related(*cls.PREFETCH_RELATED)
+
+        permissions_cache = {}
+        last_pk = None
+        while True:
+            chunk = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+            chunk = list(chunk[:chunk_size])
+            for instance in chunk:
+                validator = cls(instance, user=user, **kwargs)
+                if share_permissions:
+                    validator._permissions_cache = permissions_cache
+                yield instance, validator.is_valid, validator.errors
+            if len(chunk) < chunk_size:
+                # last chunk, no need to query for an empty one
+                return
+            last_pk = chunk[-1].pk
 
     def __init__(
             self,
@@ -51,7 +207,10 @@ class CompleteValidation(object):
                     old_instance = old
                 else:
                     old_instance = instance_class.objects.get(id=new_id)
-                new_instance = instance_class.objects.get(id=new_id)
+                if self.SINGLE_FETCH:
+                    new_instance = snapshot_instance(old_instance)
+                else:
+                    new_instance = instance_class.objects.get(id=new_id)
                 update_object(new_instance, new)
 
             else:
@@ -60,11 +219,13 @@ class CompleteValidation(object):
                 # models have m2m fields
                 # Workaround for now is not to call the validator from the
                 # serializer on new instances
-                new_instance = copy.deepcopy(old) if old else instance_class(**new)
+                new_instance = snapshot_instance(old) if old else instance_class(**new)
                 if old:
                     update_object(new_instance, new)
             new = new_instance
             old = old_instance
+        elif old is None and self.TRACKED_OLD_INSTANCE and isinstance(new, ChangeTrackingMixin):
+            old = new.get_old_instance()
 
         self.stateless = stateless
         self.new = new
@@ -82,18 +243,69 @@ class CompleteValidation(object):
         # permissions to be set in each function that is needed, this attribute
         # can change values as auto-update goes through different statuses
         self.permissions = None
+        self._permissions_cache = {}
+        self._changeset = None
         self.disable_rigid_check = disable_rigid_check
 
     def get_permissions(self, instance):
         if self.PERMISSIONS_CLASS:
-            p = self.PERMISSIONS_CLASS(
-                user=self.user,
-                instance=instance,
-                permission_structure=self.new.permission_structure(),
-                inbound_check=True)
-            return p.get_permissions()
+            # permissions only change with the status during a validation
+            # run, so compute them once per (status, user)
+            key = (getattr(instance, 'status', None), getattr(self.user, 'pk', None))
+            try:
+                return self._permissions_cache[key]
+            except KeyError:
+                pass
+            if self.PERMISSIONS_CACHE:
+                cache = caches[self.PERMISSIONS_CACHE]
+                cache_key = self.get_permissions_cache_key(instance)
+                permissions = cache.get(cache_key)
+                if permissions is None:
+                    permissions = self._compute_permissions(instance)
+                    cache.set(cache_key, permissions, self.PERMISSIONS_CACHE_TIMEOUT)
+            else:
+                permissions = self._compute_permissions(instance)
+            self._permissions_cache[key] = permissions
+            return permissions
         return None
 
+    def _compute_permissions(self, instance):
+        p = self.PERMISSIONS_CLASS(
+            user=self.user,
+            instance=instance,
+            permission_structure=self.new.permission_structure(),
+            inbound_check=True)
+        return p.get_permissions()
+
+    def get_user_role_fingerprint(self):
+        '''
+        identify the role of the user, users with the same fingerprint
+        share cached permissions
+        :return: string
+        '''
+        if not self.user:
+            return 'anonymous'
+        groups = getattr(self.user, 'groups', None)
+        group_names = sorted(groups.values_list('name', flat=True)) if groups is not None else []
+        return '{}:{}:{}'.format(
+            getattr(self.user, 'is_superuser', False),
+            getattr(self.user, 'is_staff', False),
+            ','.join(group_names),
+        )
+
+    def get_permissions_cache_key(self, instance):
+        model = type(self.new)._meta.label_lower
+        status = getattr(instance, 'status', None)
+        fingerprint = hashlib.md5(
+            self.get_user_role_fingerprint().encode('utf-8')
+        ).hexdigest()
+        return 'etools_validator:permissions:{}:{}:{}:{}'.format(
+            model,
+            status,
+            fingerprint,
+            self.PERMISSIONS_CACHE_VERSION,
+        )
+
     def check_transition_conditions(self, transition):
         if not transition:
             return True
@@ -104,6 +316,17 @@ class CompleteValidation(object):
             return True
         return has_transition_perm(transition, self.user)
 
+    @property
+    def changeset(self):
+        '''
+        changes between new and old, computed lazily and shared by the
+        validation functions of the run, also available to them through
+        etools_validator.utils.get_changeset(instance)
+        '''
+        if self._changeset is None:
+            self._changeset = Changeset(self.new, self.old)
+        return self._changeset
+
     @cached_property
     def transition(self):
         return self._get_fsm_defined_transitions(self.old_status, self.new_status)
@@ -112,10 +335,12 @@ class CompleteValidation(object):
     def transitional_validation(self):
         # set old status to get proper transitions
         self.new.status = self.old.status
+        self.changeset.clear()
 
         # set old instance on instance to make it available to the
         # validation functions
         setattr(self.new, 'old_instance', self.old)
+        setattr(self.new, '_changeset', self.changeset)
         self.permissions = self.get_permissions(self.new)
 
         # check conditions and permissions
@@ -130,8 +355,10 @@ class CompleteValidation(object):
 
         # cleanup
         delattr(self.new, 'old_instance')
+        delattr(self.new, '_changeset')
         self.permissions = None
         self.new.status = self.new_status
+        self.changeset.clear()
         return conditions_check and permissions_check
 
     @state_error_data
@@ -143,24 +370,25 @@ class CompleteValidation(object):
         # set old instance on instance to make it available to the
         # validation functions
         setattr(self.new, 'old_instance', self.old)
+        setattr(self.new, '_changeset', self.changeset)
         self.permissions = self.get_permissions(self.new)
 
-        funct_name = "state_{}_valid".format(self.new_status)
-        function = getattr(self, funct_name, None)
+        name = self.get_validation_plan().get_state_validator_name(self.new_status)
+        function = getattr(self, name, None)
         if function:
-            result = function(self.new, user=self.user)
+            with instrument(self, 'state_valid', name):
+                result = function(self.new, user=self.user)
 
         # cleanup
         delattr(self.new, 'old_instance')
+        delattr(self.new, '_changeset')
         self.permissions = None
         return result
 
     def _get_fsm_defined_transitions(self, source, target):
-        all_transitions = get_all_FIELD_transitions(self.new,
-                                                    type(self.new)._meta.get_field('status'))
-        for transition in all_transitions:
-            if transition.source == source and target in transition.target:
-                return getattr(self.new, transition.method.__name__)
+        method_name = get_fsm_transition_index(type(self.new)).get((source, target))
+        if method_name:
+            return getattr(self.new, method_name)
 
     @transition_error_data
     def auto_transition_validation(self, potential_transition):
@@ -170,14 +398,10 @@ class CompleteValidation(object):
 
     def _first_available_auto_transition(self):
 
-        potential = getattr(self.new.__class__, 'AUTO_TRANSITIONS', {})
+        model_plan = self.get_validation_plan().get_model_plan(type(self.new))
 
         # ptt: Potential Transition To List
-        list_of_status_choices = [
-            i[0] for i in self.new.__class__._meta.get_field('status').choices
-        ]
-        pttl = [i for i in potential.get(self.new.status, [])
-                if i in list_of_status_choices]
+        pttl = model_plan.auto_transitions.get(self.new.status, ())
 
         for potential_transition_to in pttl:
             possible_fsm_transition = self._get_fsm_defined_transitions(
@@ -190,8 +414,7 @@ class CompleteValidation(object):
                 logger.debug(template.format(self.new.status, potential_transition_to))
             if self.auto_transition_validation(possible_fsm_transition)[0]:
                 # get the side effects function if any
-                SIDE_EFFECTS_DICT = getattr(type(self.new), 'TRANSITION_SIDE_EFFECTS', {})
-                transition_side_effects = SIDE_EFFECTS_DICT.get(potential_transition_to, [])
+                transition_side_effects = list(model_plan.side_effects.get(potential_transition_to, ()))
 
                 return True, potential_transition_to, transition_side_effects
         return None, None, None
@@ -204,16 +427,20 @@ class CompleteValidation(object):
             originals = self.new.status, self.new_status
             self.new.status = new_status
             self.new_status = new_status
+            self.changeset.clear()
 
             state_valid = self.state_valid()
             if not state_valid[0]:
                 # set stuff back
                 self.new.status, self.new_status = originals
+                self.changeset.clear()
                 return False
 
             # if all good run all the autoupdates on that status
             for function in auto_update_functions:
-                function(self.new, old_instance=self.old, user=self.user)
+                with instrument(self, 'make_auto_transitions', _function_name(function)):
+                    function(self.new, old_instance=self.old, user=self.user)
+            self.changeset.clear()
             return True
 
     def make_auto_transitions(self):
@@ -238,12 +465,15 @@ class CompleteValidation(object):
         '''
 
         setattr(self.new, 'old_instance', self.old)
+        setattr(self.new, '_changeset', self.changeset)
         self.permissions = self.get_permissions(self.new)
         errors = []
-        for validation_function in self.BASIC_VALIDATIONS:
-            a = error_data(validation_function)(self.new)
+        for function, validation_function in self.get_validation_plan().get_basic_validations(self.BASIC_VALIDATIONS):
+            with instrument(self, 'basic_validation', _function_name(function)):
+                a = validation_function(self.new)
             errors += a[1]
         delattr(self.new, 'old_instance')
+        delattr(self.new, '_changeset')
         self.permissions = None
         return not len(errors), errors
 
@@ -255,34 +485,36 @@ class CompleteValidation(object):
         if self.old_status == self.new_status:
             return
         else:
-            SIDE_EFFECTS_DICT = getattr(
-                self.new.__class__,
-                'TRANSITION_SIDE_EFFECTS',
-                {}
-            )
-            transition_side_effects = SIDE_EFFECTS_DICT.get(
+            model_plan = self.get_validation_plan().get_model_plan(type(self.new))
+            transition_side_effects = model_plan.side_effects.get(
                 self.new_status,
-                []
+                ()
             )
             for side_effect_function in transition_side_effects:
-                side_effect_function(
-                    self.new,
-                    old_instance=self.old,
-                    user=self.user
-                )
+                with instrument(self, '_apply_current_side_effects', _function_name(side_effect_function)):
+                    side_effect_function(
+                        self.new,
+                        old_instance=self.old,
+                        user=self.user
+                    )
+            self.changeset.clear()
 
     @cached_property
     def total_validation(self):
-        if not self.basic_validation[0]:
-            return False, self.map_errors(self.basic_validation[1])
+        with instrument(self, 'basic_validation'):
+            basic_validation = self.basic_validation
+        if not basic_validation[0]:
+            return False, self.map_errors(basic_validation[1])
 
         if not self.skip_transition and not self.stateless:
-            transitional = self.transitional_validation()
+            with instrument(self, 'transitional_validation'):
+                transitional = self.transitional_validation()
             if not transitional[0]:
                 return False, self.map_errors(transitional[1])
 
         if not self.stateless:
-            state_valid = self.state_valid()
+            with instrument(self, 'state_valid'):
+                state_valid = self.state_valid()
             if not state_valid[0]:
                 return False, self.map_errors(state_valid[1])
 
@@ -290,10 +522,14 @@ class CompleteValidation(object):
             # if the current instance just transitioned, apply side-effects:
             # TODO.. this needs to be re-written and have a consistent way
             # to include side-effects on both auto-transition/manual transition
-            self._apply_current_side_effects()
-
-            if self.make_auto_transitions():
-                self.new.save()
+            with instrument(self, '_apply_current_side_effects'):
+                self._apply_current_side_effects()
+
+            with instrument(self, 'make_auto_transitions'):
+                any_transition_made = self.make_auto_transitions()
+            if any_transition_made:
+                with instrument(self, 'save'):
+                    self.new.save()
         return True, []
 
     @property
@@ -303,3 +539,17 @@ class CompleteValidation(object):
     @property
     def errors(self):
         return self.total_validation[1]
+
+    async def atotal_validation(self):
+        if 'total_validation' not in self.__dict__:
+            # validation functions, permissions and fsm conditions are sync
+            # code, run them as one unit in the thread used for sync ORM
+            # access so they do not block the event loop
+            await sync_to_async(lambda: self.total_validation, thread_sensitive=True)()
+        return self.total_validation
+
+    async def ais_valid(self):
+        return (await self.atotal_validation())[0]
+
+    async def aerrors(self):
+        return (await self.atotal_validation())[1]
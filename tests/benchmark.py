@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+"""Benchmarks for the validation engine, run against the demo project models.
+
+    $ python tests/benchmark.py --save baseline.json
+    $ python tests/benchmark.py --baseline baseline.json --fail-threshold 0.2
+
+Reports operations per second and queries per operation for each case,
+compared with the baseline when given. With --fail-threshold the run exits
+with an error when a case is slower than the baseline by more than the
+threshold (0.2 is 20%) or issues more queries per operation.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'src'))
+sys.path.insert(0, os.path.join(ROOT, 'tests', 'demoproject'))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'demo.settings')
+
+import django  # noqa: E402 isort:skip
+
+django.setup()
+
+from django.db import connection, transaction  # noqa: E402 isort:skip
+from django.test.utils import setup_test_environment, teardown_test_environment  # noqa: E402 isort:skip
+from django.urls import resolve, reverse  # noqa: E402 isort:skip
+
+from rest_framework.test import APIRequestFactory, force_authenticate  # noqa: E402 isort:skip
+
+from etools_validator.instrumentation import _QueryCounter  # noqa: E402 isort:skip
+
+from demo.factories import DemoChildModelFactory, DemoModelFactory, UserFactory  # noqa: E402 isort:skip
+from demo.sample.models import DemoModel  # noqa: E402 isort:skip
+from demo.sample.validations import ChildrenValidation, DemoModelValidation  # noqa: E402 isort:skip
+
+CASES = []
+
+
+def case(function):
+    CASES.append(function)
+    return function
+
+
+class RigidChildrenValidation(ChildrenValidation):
+    def make_auto_transitions(self):
+        # keep the object in the new status, where the rigid check runs
+        return False
+
+
+@case
+def instance_auto_transitions():
+    """Unsaved instance, auto-transitions new -> pending -> end and save"""
+    user = UserFactory(is_staff=True)
+
+    def run():
+        instance = DemoModel(name='New', document='test.pdf')
+        validator = DemoModelValidation(instance, user=user)
+        assert validator.is_valid, validator.errors
+    return run
+
+
+@case
+def dict_stateless():
+    """Dict with id, stateless"""
+    m = DemoModelFactory(name='Old', document='test.pdf')
+
+    def run():
+        validator = DemoModelValidation({'id': m.pk, 'name': 'New'}, stateless=True)
+        assert validator.is_valid, validator.errors
+    return run
+
+
+@case
+def dict_transition():
+    """Dict with id and old, transition new -> end with permissions"""
+    user = UserFactory(is_staff=True)
+    m = DemoModelFactory(name='Old', document='test.pdf')
+
+    def run():
+        validator = DemoModelValidation(
+            {'id': m.pk, 'name': 'New', 'status': DemoModel.STATUS_END},
+            old=m,
+            user=user,
+        )
+        assert validator.is_valid, validator.errors
+    return run
+
+
+@case
+def rigid_related_300():
+    """Rigid check of a related set of 300 rows"""
+    user = UserFactory(is_staff=True)
+    m = DemoModelFactory(name='Old', document='test.pdf')
+    for i in range(300):
+        DemoChildModelFactory(name='Child {}'.format(i), parent=m)
+    old = DemoModel.objects.get(pk=m.pk)
+    old.children_old = list(old.children.all())
+
+    def run():
+        validator = RigidChildrenValidation(
+            {'id': m.pk, 'name': 'New'},
+            old=old,
+            user=user,
+        )
+        assert validator.is_valid, validator.errors
+    return run
+
+
+@case
+def my_update_nested_50():
+    """ValidatorViewMixin.my_update through the update view with 50 nested children"""
+    user = UserFactory(is_staff=True)
+    m = DemoModelFactory(name='Old', document='test.pdf')
+    children = [DemoChildModelFactory(name='Child {}'.format(i), parent=m) for i in range(50)]
+    url = reverse('sample:update', args=[m.pk])
+    view = resolve(url)
+    data = {
+        'name': 'New',
+        'children': [{'id': child.pk, 'name': 'Updated {}'.format(child.pk)} for child in children],
+    }
+    factory = APIRequestFactory()
+
+    def run():
+        request = factory.put(url, data, format='json')
+        force_authenticate(request, user)
+        response = view.func(request, *view.args, **view.kwargs)
+        assert response.status_code == 200, response.data
+    return run
+
+
+def measure(setup, min_time):
+    with transaction.atomic():
+        run = setup()
+        run()  # warm up caches
+        iterations = 0
+        elapsed = 0.0
+        # counted with a wrapper, connection.queries_log is capped
+        queries = _QueryCounter()
+        with connection.execute_wrapper(queries):
+            start = time.perf_counter()
+            while elapsed < min_time:
+                run()
+                iterations += 1
+                elapsed = time.perf_counter() - start
+        transaction.set_rollback(True)
+    return {
+        'ops_per_sec': iterations / elapsed,
+        'queries_per_op': queries.queries / iterations,
+    }
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for name, result in results.items():
+        previous = baseline.get(name)
+        if not previous:
+            continue
+        if result['ops_per_sec'] < previous['ops_per_sec'] * (1 - threshold):
+            regressions.append('{}: {:.1f} ops/sec, baseline {:.1f}'.format(
+                name, result['ops_per_sec'], previous['ops_per_sec']))
+        if result['queries_per_op'] > previous['queries_per_op']:
+            regressions.append('{}: {:.1f} queries/op, baseline {:.1f}'.format(
+                name, result['queries_per_op'], previous['queries_per_op']))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--min-time', type=float, default=1.0, help='seconds to run each case for')
+    parser.add_argument('--case', action='append', help='run only the named case(s)')
+    parser.add_argument('--baseline', help='JSON file with baseline results to compare with')
+    parser.add_argument('--save', help='write results to this JSON file')
+    parser.add_argument('--fail-threshold', type=float,
+                        help='fail when slower than the baseline by more than this fraction')
+    args = parser.parse_args(argv)
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    try:
+        results = {}
+        for setup in CASES:
+            name = setup.__name__
+            if args.case and name not in args.case:
+                continue
+            result = results[name] = measure(setup, args.min_time)
+            line = '{:<28} {:>10.1f} ops/sec {:>8.1f} queries/op'.format(
+                name, result['ops_per_sec'], result['queries_per_op'])
+            if name in baseline:
+                line += ' ({:+.1%})'.format(result['ops_per_sec'] / baseline[name]['ops_per_sec'] - 1)
+            print(line)
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        teardown_test_environment()
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.fail_threshold is not None and baseline:
+        regressions = compare(results, baseline, args.fail_threshold)
+        if regressions:
+            print('Regressions:\n' + '\n'.join(regressions))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -19,6 +19,13 @@ class DemoChildModelFactory(factory.django.DjangoModelFactory):
         model = models.DemoChildModel
 
 
+class DemoAttachmentModelFactory(factory.django.DjangoModelFactory):
+    parent = factory.SubFactory(DemoModelFactory)
+
+    class Meta:
+        model = models.DemoAttachmentModel
+
+
 class SpecialModelFactory(factory.django.DjangoModelFactory):
     demo = factory.SubFactory(DemoModelFactory)
 
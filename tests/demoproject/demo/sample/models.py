@@ -3,6 +3,7 @@ from django.db import models
 from django_fsm import FSMField, transition
 
 from etools_validator.exceptions import TransitionError
+from etools_validator.tracking import ChangeTrackingMixin
 
 
 class DemoModel(models.Model):
@@ -61,8 +62,14 @@ class DemoModelNoAuto(DemoModel):
     AUTO_TRANSITIONS = {}
 
 
+class TrackedDemoModel(ChangeTrackingMixin, DemoModel):
+    class Meta:
+        proxy = True
+
+
 class DemoChildModel(models.Model):
     name = models.CharField(max_length=50)
+    data = models.JSONField(null=True, blank=True)
     parent = models.ForeignKey(
         DemoModel,
         on_delete=models.CASCADE,
@@ -70,6 +77,18 @@ class DemoChildModel(models.Model):
     )
 
 
+class DemoAttachmentModel(models.Model):
+    name = models.CharField(max_length=50)
+    attachment = models.FileField(null=True, blank=True)
+    modified = models.DateTimeField(auto_now=True)
+    parent = models.ForeignKey(
+        DemoModel,
+        on_delete=models.CASCADE,
+        related_name="attachments"
+    )
+    others = models.ManyToManyField("sample.ManyModel", blank=True)
+
+
 class SpecialModel(models.Model):
     name = models.CharField(max_length=50)
     demo = models.OneToOneField(
@@ -5,8 +5,8 @@ def pend_permission(instance, user):
 
 
 class DemoModelPermissions:
-    def __init__(self, **kwargs):
-        """Placeholder"""
+    def __init__(self, instance=None, **kwargs):
+        self.instance = instance
 
     def get_permissions(self):
         return {
@@ -19,3 +19,21 @@ class DemoModelPermissions:
                 "special": True,
             }
         }
+
+
+class ChildrenPermissions(DemoModelPermissions):
+    """Children can not be edited in the new status"""
+
+    def get_permissions(self):
+        permissions = super().get_permissions()
+        permissions["edit"]["children"] = self.instance.status != self.instance.STATUS_NEW
+        return permissions
+
+
+class NamePermissions(DemoModelPermissions):
+    """Name can not be edited"""
+
+    def get_permissions(self):
+        permissions = super().get_permissions()
+        permissions["edit"]["name"] = False
+        return permissions
@@ -1,6 +1,6 @@
 from rest_framework import serializers
 
-from .models import DemoChildModel, DemoModel, SpecialModel
+from .models import DemoAttachmentModel, DemoChildModel, DemoModel, SpecialModel
 
 
 class DemoChildModelSerializer(serializers.ModelSerializer):
@@ -9,6 +9,12 @@ class DemoChildModelSerializer(serializers.ModelSerializer):
         fields = "__all__"
 
 
+class DemoAttachmentModelSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = DemoAttachmentModel
+        exclude = ("others",)
+
+
 class SpecialModelSerializer(serializers.ModelSerializer):
     class Meta:
         model = SpecialModel
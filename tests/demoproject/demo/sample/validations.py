@@ -2,7 +2,7 @@ from etools_validator.exceptions import StateValidationError
 from etools_validator.utils import check_rigid_fields
 from etools_validator.validation import CompleteValidation
 
-from .permissions import DemoModelPermissions
+from .permissions import ChildrenPermissions, DemoModelPermissions, NamePermissions
 
 
 def demo_validation(instance):
@@ -49,3 +49,20 @@ class ProtectedDemoModelValidation(DemoModelValidation):
     def state_new_valid(self, instance, user=None):
         self.check_rigid_fields(instance, related=True)
         return True
+
+
+class TrackedDemoModelValidation(ProtectedDemoModelValidation):
+    VALIDATION_CLASS = "sample.TrackedDemoModel"
+    TRACKED_OLD_INSTANCE = True
+
+
+class NameValidation(DemoModelValidation):
+    PERMISSIONS_CLASS = NamePermissions
+
+
+class ChildrenValidation(ProtectedDemoModelValidation):
+    PERMISSIONS_CLASS = ChildrenPermissions
+
+
+class TrackedNameValidation(TrackedDemoModelValidation):
+    PERMISSIONS_CLASS = NamePermissions
@@ -6,7 +6,12 @@ from rest_framework.serializers import ValidationError
 from etools_validator.mixins import ValidatorViewMixin
 
 from .models import DemoModel
-from .serializers import DemoChildModelSerializer, DemoModelSerializer, SpecialModelSerializer
+from .serializers import (
+    DemoAttachmentModelSerializer,
+    DemoChildModelSerializer,
+    DemoModelSerializer,
+    SpecialModelSerializer,
+)
 from .validations import DemoModelValidation
 
 
@@ -48,15 +53,15 @@ class DemoUpdateView(ValidatorViewMixin, UpdateAPIView):
         "children": DemoChildModelSerializer,
         "special": SpecialModelSerializer,
     }
+    related_fields = ['children', 'special']
 
     def get_validation_class(self):
         return self.validation_class
 
     def update(self, request, *args, **kwargs):
-        related_fields = ['children', 'special']
         instance, old_instance, serializer = self.my_update(
             request,
-            related_fields,
+            self.related_fields,
             **kwargs
         )
 
@@ -77,6 +82,15 @@ class DemoUpdateView(ValidatorViewMixin, UpdateAPIView):
         )
 
 
+class DemoBulkUpdateView(DemoUpdateView):
+    SERIALIZER_MAP = {
+        "children": DemoChildModelSerializer,
+        "attachments": DemoAttachmentModelSerializer,
+    }
+    BULK_RELATED_FIELDS = ("children", "attachments")
+    related_fields = ['children', 'attachments']
+
+
 class DemoUpdateNonSerializedView(ValidatorViewMixin, UpdateAPIView):
     queryset = DemoModel.objects.all()
     serializer_class = DemoModelSerializer
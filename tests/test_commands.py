@@ -0,0 +1,144 @@
+import json
+import multiprocessing
+import os
+import tempfile
+from io import StringIO
+
+from django.core.management import call_command, CommandError
+
+import pytest
+from unittest import TestCase
+from unittest.mock import patch
+
+from etools_validator.management.commands.revalidate import Command, revalidate_slice
+
+from demo.factories import DemoModelFactory
+from demo.sample.models import DemoModel
+
+pytestmark = pytest.mark.django_db
+
+
+class TestRevalidateCommand(TestCase):
+    validator = "demo.sample.validations.DemoModelValidation"
+
+    def setUp(self):
+        DemoModel.objects.all().delete()
+        self.valid = DemoModelFactory(name="Valid", document="test.pdf")
+        self.invalid = DemoModelFactory(name="Invalid")
+
+    def test_revalidate_slice(self):
+        results = revalidate_slice(
+            "sample.DemoModel",
+            self.validator,
+            self.valid.pk,
+            self.valid.pk + 1,
+            10,
+            True,
+        )
+        self.assertEqual(results, [{"pk": self.valid.pk, "valid": True, "errors": []}])
+        results = revalidate_slice("sample.DemoModel", self.validator, self.invalid.pk, None, 10, True)
+        self.assertEqual([result["pk"] for result in results], [self.invalid.pk])
+
+    def test_revalidate(self):
+        out, err = StringIO(), StringIO()
+        call_command("revalidate", "sample.DemoModel", validator=self.validator, stdout=out, stderr=err)
+        results = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual(results, [
+            {"pk": self.valid.pk, "valid": True, "errors": []},
+            {"pk": self.invalid.pk, "valid": False, "errors": ["demo_validation"]},
+        ])
+        self.assertIn("Validated 2 objects, 1 invalid", err.getvalue())
+
+    def test_revalidate_share_permissions(self):
+        with patch("etools_validator.validation.CompleteValidation.validate_many", return_value=[]) as validate_mock:
+            call_command("revalidate", "sample.DemoModel", validator=self.validator, stderr=StringIO())
+            self.assertFalse(validate_mock.call_args[1]["share_permissions"])
+            call_command(
+                "revalidate",
+                "sample.DemoModel",
+                validator=self.validator,
+                share_permissions=True,
+                stderr=StringIO(),
+            )
+            self.assertTrue(validate_mock.call_args[1]["share_permissions"])
+
+    def test_revalidate_streams(self):
+        out = StringIO()
+
+        def validate_many(queryset, **kwargs):
+            for count, instance in enumerate(queryset.order_by("pk")):
+                # previous results are written before the next one is validated
+                self.assertEqual(len(out.getvalue().splitlines()), count)
+                yield instance, True, []
+
+        with patch("etools_validator.validation.CompleteValidation.validate_many", side_effect=validate_many):
+            call_command("revalidate", "sample.DemoModel", validator=self.validator, stdout=out, stderr=StringIO())
+        self.assertEqual(len(out.getvalue().splitlines()), 2)
+
+    def test_get_slices(self):
+        command = Command()
+        self.assertEqual(command.get_slices(DemoModel, 1, 2), [(None, None)])
+        # sparse pks, slices follow the rows not the pk range
+        for pk in [100, 1000, 5000, 100000]:
+            DemoModelFactory(pk=pk)
+        pks = list(DemoModel.objects.order_by("pk").values_list("pk", flat=True))
+        self.assertEqual(command.get_slices(DemoModel, 2, 2), [
+            (pks[0], pks[2]),
+            (pks[2], pks[4]),
+            (pks[4], None),
+        ])
+        self.assertEqual(command.get_slices(DemoModel, 2, 100), [(pks[0], None)])
+        DemoModel.objects.all().delete()
+        self.assertEqual(command.get_slices(DemoModel, 2, 2), [])
+        self.assertEqual(command.get_slices(DemoModel, 1, 2), [])
+
+    def test_revalidate_output(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "report.jsonl")
+            call_command(
+                "revalidate",
+                "sample.DemoModel",
+                validator=self.validator,
+                output=path,
+                stderr=StringIO(),
+            )
+            with open(path) as report:
+                self.assertEqual(len(report.readlines()), 2)
+
+    def test_invalid_chunk_size(self):
+        for workers in [1, 2]:
+            with self.assertRaisesRegex(CommandError, "--chunk-size must be at least 1"):
+                call_command("revalidate", "sample.DemoModel", validator=self.validator, workers=workers, chunk_size=0)
+
+    @pytest.mark.skipif(
+        multiprocessing.get_start_method() != "fork",
+        reason="workers only see the in memory test database when forked",
+    )
+    def test_revalidate_workers(self):
+        for i in range(5):
+            DemoModelFactory(name="Valid {}".format(i), document="test.pdf")
+        out, err = StringIO(), StringIO()
+        call_command(
+            "revalidate",
+            "sample.DemoModel",
+            validator=self.validator,
+            workers=2,
+            chunk_size=2,
+            stdout=out,
+            stderr=err,
+        )
+        results = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertCountEqual(
+            [result["pk"] for result in results],
+            DemoModel.objects.values_list("pk", flat=True),
+        )
+        self.assertEqual([result["pk"] for result in results if not result["valid"]], [self.invalid.pk])
+        self.assertIn("Validated 7 objects, 1 invalid", err.getvalue())
+
+    def test_unknown_model(self):
+        with self.assertRaisesRegex(CommandError, "Unknown model"):
+            call_command("revalidate", "sample.Unknown", validator=self.validator)
+
+    def test_unknown_validator(self):
+        with self.assertRaisesRegex(CommandError, "Unable to import validator"):
+            call_command("revalidate", "sample.DemoModel", validator="demo.Unknown")
@@ -0,0 +1,113 @@
+import datetime
+from collections import OrderedDict
+from decimal import Decimal
+
+from django.db import models as db_models
+from django.test import override_settings
+from django.utils import timezone
+
+import pytest
+from unittest import TestCase
+
+from etools_validator import comparators, utils
+
+from demo.sample import models
+
+pytestmark = pytest.mark.django_db
+
+
+class TestGetFieldComparator(TestCase):
+    def test_cached(self):
+        field = models.DemoModel._meta.get_field("name")
+        self.assertIs(comparators.get_field_comparator(field), comparators.get_field_comparator(field))
+
+    def test_resolved_by_field_type(self):
+        field = models.DemoModel._meta.get_field("document")
+        self.assertIs(comparators.get_field_comparator(field).func, comparators.file_comparison)
+        field = models.DemoModel._meta.get_field("name")
+        self.assertIs(comparators.get_field_comparator(field).func, comparators.default_comparison)
+
+    def test_register(self):
+        class UpperField(db_models.CharField):
+            pass
+
+        def upper_comparison(field, value1, value2):
+            return value1.upper() == value2.upper()
+
+        field = UpperField(max_length=10)
+        self.assertFalse(comparators.get_field_comparator(field)("a", "A"))
+        utils.get_rigid_comparators(models.DemoModel)
+        try:
+            self.assertIs(comparators.register_comparator(UpperField, upper_comparison), upper_comparison)
+            self.assertNotIn(models.DemoModel, utils._rigid_comparators_cache)
+            self.assertTrue(comparators.get_field_comparator(field)("a", "A"))
+        finally:
+            del comparators._registry[UpperField]
+            comparators._resolved.clear()
+
+
+class TestComparisons(TestCase):
+    def test_default(self):
+        compare = comparators.get_field_comparator(db_models.IntegerField())
+        self.assertTrue(compare(1, 1))
+        self.assertTrue(compare(1, "1"))
+        self.assertFalse(compare(1, 2))
+        self.assertFalse(compare(None, 0))
+        self.assertFalse(compare(1, "x"))
+
+    def test_decimal(self):
+        compare = comparators.get_field_comparator(db_models.DecimalField(max_digits=5, decimal_places=2))
+        self.assertTrue(compare(Decimal("1.10"), Decimal("1.1")))
+        self.assertTrue(compare(Decimal("1.10"), 1.1))
+        self.assertTrue(compare(Decimal("1.10"), "1.1"))
+        self.assertFalse(compare(Decimal("1.10"), 1.2))
+
+    def test_float(self):
+        compare = comparators.get_field_comparator(db_models.FloatField())
+        self.assertTrue(compare(1.5, Decimal("1.5")))
+        self.assertFalse(compare(1.5, Decimal("1.6")))
+
+    @override_settings(USE_TZ=True, TIME_ZONE="UTC")
+    def test_datetime(self):
+        compare = comparators.get_field_comparator(db_models.DateTimeField())
+        naive = datetime.datetime(2020, 1, 1, 12)
+        aware = timezone.make_aware(naive, datetime.timezone.utc)
+        self.assertTrue(compare(naive, aware))
+        self.assertTrue(compare(aware, aware.astimezone(datetime.timezone(datetime.timedelta(hours=2)))))
+        self.assertFalse(compare(naive, aware + datetime.timedelta(seconds=1)))
+
+    def test_text(self):
+        compare = comparators.get_field_comparator(db_models.TextField())
+        text = "x" * 100000
+        self.assertTrue(compare(text, text))
+        self.assertTrue(compare(text, "x" * 100000))
+        self.assertFalse(compare(text, text[:-1] + "y"))
+        self.assertFalse(compare(text, text[:-1]))
+        self.assertFalse(compare(text, None))
+
+    def test_json(self):
+        compare = comparators.get_field_comparator(db_models.JSONField())
+        value = {"a": [1, 2], "b": {"c": 3}}
+        self.assertTrue(compare(value, value))
+        self.assertTrue(compare(value, {"b": {"c": 3}, "a": [1, 2]}))
+        self.assertFalse(compare(value, {"a": [1, 2]}))
+        self.assertFalse(compare(value, {"a": [1, 2], "b": {"c": 4}}))
+        self.assertFalse(compare([1], {"a": 1}))
+        self.assertTrue(compare(OrderedDict(a=1), {"a": 1}))
+        self.assertFalse(compare(OrderedDict(a=1), {"a": 2}))
+        self.assertTrue(compare(1, 1.0))
+        self.assertTrue(compare("text", "text"))
+
+    def test_file(self):
+        m = models.DemoModel(document="test.pdf")
+        compare = comparators.get_field_comparator(models.DemoModel._meta.get_field("document"))
+        self.assertTrue(compare(m.document, models.DemoModel(document="test.pdf").document))
+        self.assertTrue(compare(models.DemoModel(document="").document, None))
+        self.assertFalse(compare(m.document, models.DemoModel(document="other.pdf").document))
+
+    def test_json_changeset(self):
+        old = models.DemoChildModel(pk=1, name="Child", data={"a": [1, 2]})
+        new = models.DemoChildModel(pk=1, name="Child", data=OrderedDict(a=[1, 2]))
+        self.assertFalse(utils.Changeset(new, old).has_changed("data"))
+        new.data["a"].append(3)
+        self.assertTrue(utils.Changeset(new, old).has_changed("data"))
@@ -0,0 +1,58 @@
+from django.db import connection
+
+import pytest
+from unittest import TestCase
+
+from etools_validator.instrumentation import instrument, TimingCollector, validation_timing
+
+from demo.factories import UserFactory
+from demo.sample.models import DemoModel
+from demo.sample.validations import DemoModelValidation
+
+pytestmark = pytest.mark.django_db
+
+
+class TestInstrument(TestCase):
+    def test_no_listeners(self):
+        self.assertFalse(validation_timing.has_listeners())
+        with instrument(None, "phase"):
+            pass
+
+    def test_collect(self):
+        with TimingCollector() as collector:
+            with instrument(None, "phase", "function"):
+                with connection.cursor() as cursor:
+                    cursor.execute("SELECT 1")
+        self.assertFalse(validation_timing.has_listeners())
+        self.assertEqual(len(collector.timings), 1)
+        timing = collector.timings[0]
+        self.assertEqual(timing.phase, "phase")
+        self.assertEqual(timing.function, "function")
+        self.assertEqual(timing.queries, 1)
+        self.assertGreaterEqual(timing.duration, timing.db_time)
+
+
+class TestValidationTimings(TestCase):
+    def test_phases(self):
+        user = UserFactory(is_staff=True)
+        v = DemoModelValidation(
+            {"name": "New", "document": "test.pdf"},
+            user=user,
+            instance_class=DemoModel,
+        )
+        with TimingCollector() as collector:
+            self.assertTrue(v.is_valid)
+        self.assertEqual(v.new.status, DemoModel.STATUS_END)
+
+        phases = [timing.phase for timing in collector.timings if timing.function is None]
+        self.assertEqual(phases, [
+            "basic_validation",
+            "state_valid",
+            "_apply_current_side_effects",
+            "make_auto_transitions",
+            "save",
+        ])
+        self.assertEqual(len(collector.for_phase("basic_validation", "demo_validation")), 1)
+        self.assertEqual(len(collector.for_phase("state_valid", "state_pending_valid")), 1)
+        self.assertEqual(collector.for_phase("save")[0].queries, 1)
+        self.assertTrue(all(timing.validator is v for timing in collector.timings))
@@ -1,23 +1,115 @@
+import datetime
+
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.storage import default_storage
 from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.db.models import Count
+from django.test.utils import CaptureQueriesContext
 from django.urls import resolve, reverse
 
-from rest_framework import status
+from rest_framework import serializers, status
+from rest_framework.generics import UpdateAPIView
 from rest_framework.test import APIRequestFactory, force_authenticate
 
 import pytest
 from unittest import TestCase
 from unittest.mock import patch
 
-from etools_validator.mixins import ValidatorViewMixin
+from etools_validator.mixins import RelatedField, ValidatorViewMixin
+from etools_validator.utils import RelatedChecksum, RelatedFingerprints
 
-from demo.factories import DemoChildModelFactory, DemoModelFactory, ManyModelFactory, SpecialModelFactory, UserFactory
-from demo.sample.models import DemoChildModel, DemoModel, SpecialModel
+from demo.factories import (
+    DemoAttachmentModelFactory,
+    DemoChildModelFactory,
+    DemoModelFactory,
+    ManyModelFactory,
+    SpecialModelFactory,
+    UserFactory,
+)
+from demo.sample.models import DemoAttachmentModel, DemoChildModel, DemoModel, SpecialModel
 from demo.sample.permissions import DemoModelPermissions
-from demo.sample.validations import ProtectedDemoModelValidation
+from demo.sample.serializers import DemoChildModelSerializer, DemoModelSerializer
+from demo.sample.validations import (
+    ChildrenValidation,
+    DemoModelValidation,
+    NameValidation,
+    ProtectedDemoModelValidation,
+)
+from demo.sample.views import DemoBulkUpdateView, DemoUpdateView
 
 pytestmark = pytest.mark.django_db
 
 
+class TestRelatedFields(TestCase):
+    def test_compiled_on_class_creation(self):
+        related_fields = DemoUpdateView._related_fields_cache[DemoModel]
+        self.assertEqual(related_fields["children"], RelatedField(
+            name="children",
+            related_model=DemoChildModel,
+            reverse_name="parent",
+            serializer=DemoChildModelSerializer,
+            one_to_one=False,
+        ))
+        self.assertTrue(related_fields["special"].one_to_one)
+        self.assertEqual(related_fields["special"].reverse_name, "demo")
+
+    def test_unknown_field(self):
+        with self.assertRaisesRegex(ImproperlyConfigured, "has no field missing"):
+            class MissingView(ValidatorViewMixin, UpdateAPIView):
+                queryset = DemoModel.objects.all()
+                SERIALIZER_MAP = {"missing": DemoChildModelSerializer}
+
+    def test_not_reverse_relation(self):
+        for name in ["name", "others"]:
+            with self.assertRaisesRegex(ImproperlyConfigured, "is not a reverse"):
+                class WrongView(ValidatorViewMixin, UpdateAPIView):
+                    queryset = DemoModel.objects.all()
+                    SERIALIZER_MAP = {name: DemoChildModelSerializer}
+
+    def test_bulk_not_in_serializer_map(self):
+        with self.assertRaisesRegex(ImproperlyConfigured, "special is not in SERIALIZER_MAP"):
+            class BulkView(ValidatorViewMixin, UpdateAPIView):
+                queryset = DemoModel.objects.all()
+                SERIALIZER_MAP = {"children": DemoChildModelSerializer}
+                BULK_RELATED_FIELDS = ("special",)
+
+    def test_bulk_many_to_many(self):
+        class AttachmentSerializer(serializers.ModelSerializer):
+            class Meta:
+                model = DemoAttachmentModel
+                fields = "__all__"
+
+        with self.assertRaisesRegex(ImproperlyConfigured, "writes others"):
+            class BulkView(ValidatorViewMixin, UpdateAPIView):
+                queryset = DemoModel.objects.all()
+                SERIALIZER_MAP = {"attachments": AttachmentSerializer}
+                BULK_RELATED_FIELDS = ("attachments",)
+
+    def test_bulk_nested(self):
+        class NestedSerializer(serializers.ModelSerializer):
+            parent = DemoModelSerializer()
+
+            class Meta:
+                model = DemoChildModel
+                fields = "__all__"
+
+        with self.assertRaisesRegex(ImproperlyConfigured, "writes parent"):
+            class BulkView(ValidatorViewMixin, UpdateAPIView):
+                queryset = DemoModel.objects.all()
+                SERIALIZER_MAP = {"children": NestedSerializer}
+                BULK_RELATED_FIELDS = ("children",)
+
+    def test_compiled_on_first_use(self):
+        class NoModelView(ValidatorViewMixin, UpdateAPIView):
+            SERIALIZER_MAP = {"children": DemoChildModelSerializer}
+
+        self.assertEqual(NoModelView._related_fields_cache, {})
+        related_field = NoModelView().get_related_field(DemoModel(), "children")
+        self.assertEqual(related_field.related_model, DemoChildModel)
+        self.assertIn(DemoModel, NoModelView._related_fields_cache)
+
+
 @pytest.mark.parametrize("param", ['', None, 'true', 'false'])
 def test_validatorviewmixin(param):
     request = APIRequestFactory()
@@ -106,6 +198,44 @@ class TestValidatorViewMixin(TestCase):
         child_updated = DemoChildModel.objects.get(pk=child.pk)
         self.assertEqual(child_updated.name, "Updated Child")
 
+    def test_update_fetches_once(self):
+        m = DemoModelFactory(name="Old", document="test.txt")
+        child = DemoChildModelFactory(parent=m, name="Old Child")
+        factory = APIRequestFactory()
+        request = factory.put(reverse("sample:update", args=[m.pk]), {
+            "name": "New",
+            "children": [{"id": child.pk, "parent": m.pk, "name": "Updated Child"}],
+        }, format="json")
+        force_authenticate(request, UserFactory())
+        view = DemoUpdateView.as_view(queryset=DemoModel.objects.prefetch_related("children"))
+        with patch.object(DemoUpdateView, "get_object", autospec=True,
+                          side_effect=DemoUpdateView.get_object) as get_object_mock:
+            response = view(request, pk=m.pk)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(get_object_mock.call_count, 1)
+        self.assertEqual(response.data["name"], "New")
+        self.assertEqual([c["name"] for c in response.data["children"]], ["Updated Child"])
+
+    def test_update_annotated_queryset(self):
+        counts = []
+
+        class CountValidation(DemoModelValidation):
+            def state_new_valid(self, instance, user=None):
+                counts.append((instance.old_instance.children_count, instance.children_count))
+                return True
+
+        m = DemoModelFactory(name="Old", document="test.txt")
+        DemoChildModelFactory(parent=m)
+        request = APIRequestFactory().put(reverse("sample:update", args=[m.pk]), {"name": "New"}, format="json")
+        force_authenticate(request, UserFactory())
+        view = DemoUpdateView.as_view(
+            queryset=DemoModel.objects.annotate(children_count=Count("children")),
+            validation_class=CountValidation,
+        )
+        response = view(request, pk=m.pk)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(counts, [(1, 1)])
+
     def test_update_special_update(self):
         m = DemoModelFactory(name="Old", document="test.txt")
         special = SpecialModelFactory(
@@ -175,6 +305,133 @@ class TestValidatorViewMixin(TestCase):
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
         self.assertIn('Cannot change fields while in new: special', response.data)
 
+    @patch('demo.sample.views.DemoUpdateView.get_validation_class')
+    def test_update_children_fingerprints_protected(self, validation_mock):
+        class FingerprintsValidation(ChildrenValidation):
+            def state_new_valid(self, instance, user=None):
+                assert isinstance(instance.old_instance.children_old, RelatedFingerprints)
+                return super().state_new_valid(instance, user=user)
+
+        validation_mock.return_value = FingerprintsValidation
+
+        m = DemoModelFactory(name="Old", document="test.txt")
+        child = DemoChildModelFactory(parent=m, name="Old Child")
+        with patch.object(DemoUpdateView, 'FINGERPRINT_RELATED_SNAPSHOTS', True):
+            response = self._get_response(
+                "put",
+                reverse("sample:update", args=[m.pk]),
+                {"name": "New", "children": [{"id": child.pk, "name": "Old Child"}]},
+                format="json"
+            )
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+            response = self._get_response(
+                "put",
+                reverse("sample:update", args=[m.pk]),
+                {"name": "New", "children": [{"id": child.pk, "name": "Updated Child"}]},
+                format="json"
+            )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('Cannot change fields while in new: children', response.data)
+
+    @patch('demo.sample.views.DemoUpdateView.get_validation_class')
+    def test_update_permission_related_snapshots(self, validation_mock):
+        snapshots = []
+
+        class SnapshotsValidation(ChildrenValidation):
+            def state_new_valid(self, instance, user=None):
+                snapshots.append((
+                    hasattr(instance.old_instance, "children_old"),
+                    hasattr(instance.old_instance, "special_old"),
+                ))
+                return super().state_new_valid(instance, user=user)
+
+        validation_mock.return_value = SnapshotsValidation
+
+        m = DemoModelFactory(name="Old", document="test.txt")
+        child = DemoChildModelFactory(parent=m, name="Old Child")
+        SpecialModelFactory(demo=m, name="Special")
+        with patch.object(DemoUpdateView, 'PERMISSION_RELATED_SNAPSHOTS', True):
+            response = self._get_response(
+                "put",
+                reverse("sample:update", args=[m.pk]),
+                {"name": "New", "children": [{"id": child.pk, "name": "Updated Child"}]},
+                format="json"
+            )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('Cannot change fields while in new: children', response.data)
+        self.assertEqual(snapshots, [(True, False)])
+
+    def test_related_snapshot_names(self):
+        m = DemoModelFactory(name="Old", status="pending")
+        view = DemoUpdateView()
+        view.request = APIRequestFactory().put("/")
+        view.request.user = UserFactory()
+
+        class StatusPermissions(DemoModelPermissions):
+            def get_permissions(self):
+                permissions = super().get_permissions()
+                permissions['edit']['children'] = self.instance.status != "end"
+                return permissions
+
+        class StatusValidation(ProtectedDemoModelValidation):
+            PERMISSIONS_CLASS = StatusPermissions
+
+        names = ["children", "special", "others"]
+        self.assertEqual(view.get_related_snapshot_names(m, {}, names), names)
+        view.PERMISSION_RELATED_SNAPSHOTS = True
+        view.validation_class = StatusValidation
+        self.assertEqual(view.get_related_snapshot_names(m, {}, names), ["others"])
+        self.assertEqual(view.get_related_snapshot_names(m, {"status": "end"}, names), ["children", "others"])
+        self.assertEqual(m.status, "pending")
+        view.validation_class = DemoModelValidation
+        self.assertEqual(view.get_related_snapshot_names(m, {}, names), names)
+
+    @patch('demo.sample.views.DemoUpdateView.get_validation_class')
+    def test_update_db_rigid_fields_check(self, validation_mock):
+        validation_mock.return_value = NameValidation
+
+        m = DemoModelFactory(name="Old", document="test.txt")
+        url = reverse("sample:update", args=[m.pk])
+        with patch.object(DemoUpdateView, 'DB_RIGID_FIELDS_CHECK', True):
+            response = self._get_response("put", url, {"name": "Old", "description": "New"}, format="json")
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+            # rejected before the save, after it the database has the new name
+            response = self._get_response("put", url, {"name": "New"}, format="json")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data, ['Cannot change fields while in new: name'])
+        self.assertEqual(DemoModel.objects.get(pk=m.pk).name, "Old")
+
+    @patch('demo.sample.views.DemoUpdateView.get_validation_class')
+    def test_update_children_checksum_protected(self, validation_mock):
+        class ChecksumValidation(ChildrenValidation):
+            def state_new_valid(self, instance, user=None):
+                assert isinstance(instance.old_instance.children_old, RelatedChecksum)
+                return super().state_new_valid(instance, user=user)
+
+        validation_mock.return_value = ChecksumValidation
+
+        m = DemoModelFactory(name="Old", document="test.txt")
+        child = DemoChildModelFactory(parent=m, name="Old Child")
+        with patch.object(DemoUpdateView, 'CHECKSUM_RELATED_SNAPSHOTS', True):
+            response = self._get_response(
+                "put",
+                reverse("sample:update", args=[m.pk]),
+                {"name": "New", "children": [{"id": child.pk, "name": "Updated Child"}]},
+                format="json"
+            )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('Cannot change fields while in new: children', response.data)
+
+    @patch('etools_validator.mixins.get_related_checksum', return_value=None)
+    def test_update_checksum_unsupported(self, _checksum_mock):
+        m = DemoModelFactory(name="Old", document="test.txt")
+        child = DemoChildModelFactory(parent=m, name="Old Child")
+        view = DemoUpdateView()
+        view.CHECKSUM_RELATED_SNAPSHOTS = True
+        self.assertEqual(view._snapshot_related(m.children), [child])
+
     def test_update_non_serialized_update(self):
         m = DemoModelFactory(name="Old", document="test.txt")
         self.assertEqual(list(m.others.all()), [])
@@ -215,6 +472,126 @@ class TestValidatorViewMixin(TestCase):
         self.assertEqual(response.data["name"], "Update")
         self.assertTrue(child_qs.exists())
 
+    def test_update_children_loaded_in_bulk(self):
+        m = DemoModelFactory(name="Old", document="test.txt")
+        children = [DemoChildModelFactory(parent=m, name="Old Child") for _ in range(10)]
+        data = {
+            "name": "New",
+            "children": [
+                {"id": child.pk, "parent": m.pk, "name": "Updated Child"} for child in children
+            ] + [{"id": 404, "parent": m.pk, "name": "New Child"}],
+        }
+        with CaptureQueriesContext(connection) as queries:
+            response = self._get_response("put", reverse("sample:update", args=[m.pk]), data, format="json")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        # one query for all the children by id, none per child
+        child_selects = [
+            query["sql"] for query in queries.captured_queries
+            if 'FROM "sample_demochildmodel" WHERE "sample_demochildmodel"."id"' in query["sql"]
+        ]
+        self.assertEqual(len(child_selects), 1)
+        self.assertIn('"sample_demochildmodel"."id" IN', child_selects[0])
+        self.assertEqual(DemoChildModel.objects.filter(parent=m, name="Updated Child").count(), 10)
+        self.assertTrue(DemoChildModel.objects.filter(parent=m, name="New Child").exists())
+
+    def _bulk_update(self, m, data):
+        factory = APIRequestFactory()
+        request = factory.put(reverse("sample:update", args=[m.pk]), data, format="json")
+        force_authenticate(request, UserFactory())
+        view = DemoUpdateView.as_view(BULK_RELATED_FIELDS=("children",))
+        return view(request, pk=m.pk)
+
+    def test_update_children_bulk(self):
+        m = DemoModelFactory(name="Old", document="test.txt")
+        children = [DemoChildModelFactory(parent=m, name="Old Child") for _ in range(10)]
+        data = {
+            "name": "New",
+            "children": [
+                {"id": child.pk, "parent": m.pk, "name": "Updated Child"} for child in children[:5]
+            ] + [
+                {"id": child.pk, "parent": m.pk, "name": "Old Child"} for child in children[5:]
+            ] + [
+                {"parent": m.pk, "name": "New Child"},
+                {"id": 404, "parent": m.pk, "name": "New Child"},
+            ],
+        }
+        with CaptureQueriesContext(connection) as queries:
+            response = self._bulk_update(m, data)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        child_writes = [
+            query["sql"] for query in queries.captured_queries
+            if query["sql"].startswith(('INSERT INTO "sample_demochildmodel"', 'UPDATE "sample_demochildmodel"'))
+        ]
+        self.assertEqual(len(child_writes), 2)
+        self.assertIn('SET "name"', child_writes[1])
+        self.assertNotIn('"parent_id"', child_writes[1])
+        self.assertEqual(DemoChildModel.objects.filter(parent=m, name="Updated Child").count(), 5)
+        self.assertEqual(DemoChildModel.objects.filter(parent=m, name="Old Child").count(), 5)
+        self.assertEqual(DemoChildModel.objects.filter(parent=m, name="New Child").count(), 2)
+
+    def test_update_attachments_bulk_auto_now(self):
+        m = DemoModelFactory(name="Old", document="test.txt")
+        updated = DemoAttachmentModelFactory(parent=m, name="Old Attachment")
+        unchanged = DemoAttachmentModelFactory(parent=m, name="Old Attachment")
+        DemoAttachmentModel.objects.update(modified=datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc))
+        request = APIRequestFactory().put(reverse("sample:update", args=[m.pk]), {
+            "name": "New",
+            "attachments": [
+                {"id": updated.pk, "parent": m.pk, "name": "New Attachment"},
+                {"id": unchanged.pk, "parent": m.pk, "name": "Old Attachment"},
+            ],
+        }, format="json")
+        force_authenticate(request, UserFactory())
+        response = DemoBulkUpdateView.as_view()(request, pk=m.pk)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        updated.refresh_from_db()
+        unchanged.refresh_from_db()
+        self.assertEqual(updated.name, "New Attachment")
+        self.assertGreater(updated.modified.year, 2020)
+        self.assertEqual(unchanged.modified.year, 2020)
+
+    def test_update_attachments_bulk_file(self):
+        m = DemoModelFactory(name="Old", document="test.txt")
+        attachment = DemoAttachmentModelFactory(parent=m, name="Attachment", attachment="bulk.txt")
+        request = APIRequestFactory().put(reverse("sample:update", args=[m.pk]), {
+            "name": "New",
+            "attachments[0][_obj][id]": attachment.pk,
+            "attachments[0][_obj][parent]": m.pk,
+            "attachments[0][_obj][name]": "Attachment",
+            "attachments[0][_obj][attachment]": SimpleUploadedFile("bulk.txt", b"Updated"),
+            "attachments[1][_obj][parent]": m.pk,
+            "attachments[1][_obj][name]": "New Attachment",
+            "attachments[1][_obj][attachment]": SimpleUploadedFile("bulk_new.txt", b"New"),
+        })
+        force_authenticate(request, UserFactory())
+        response = DemoBulkUpdateView.as_view()(request, pk=m.pk)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        attachment.refresh_from_db()
+        created = DemoAttachmentModel.objects.get(parent=m, name="New Attachment")
+        for instance, content in [(attachment, b"Updated"), (created, b"New")]:
+            self.assertTrue(default_storage.exists(instance.attachment.name))
+            with instance.attachment.open() as f:
+                self.assertEqual(f.read(), content)
+            default_storage.delete(instance.attachment.name)
+
+    def test_update_children_bulk_invalid(self):
+        m = DemoModelFactory(name="Old", document="test.txt")
+        child = DemoChildModelFactory(parent=m, name="Old Child")
+        data = {
+            "name": "New",
+            "children": [
+                {"id": child.pk, "parent": m.pk, "name": "Updated Child"},
+                {"parent": m.pk},
+            ],
+        }
+        response = self._bulk_update(m, data)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data, {
+            "children": [{}, {"name": ["This field is required."]}]
+        })
+        self.assertEqual(DemoChildModel.objects.get(pk=child.pk).name, "Old Child")
+        self.assertEqual(DemoChildModel.objects.filter(parent=m).count(), 1)
+
     def test_update_children_create_invalid(self):
         m = DemoModelFactory(name="Old", document="test.txt")
         child_qs = DemoChildModel.objects.filter(parent=m)
@@ -261,6 +638,23 @@ class TestValidatorViewMixin(TestCase):
         self.assertEqual(response.data["name"], "Update")
         self.assertTrue(child_qs.exists())
 
+    def test_update_children_malformed_id(self):
+        m = DemoModelFactory(name="Old", document="test.txt")
+        child_qs = DemoChildModel.objects.filter(parent=m)
+        response = self._get_response(
+            "put",
+            reverse("sample:update", args=[m.pk]),
+            {
+                "name": "Update",
+                "children": [{"id": "abc", "parent": m.pk, "name": "New Child"}],
+            },
+            format="json"
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(list(response.data), ["children"])
+        self.assertIn("id", response.data["children"])
+        self.assertFalse(child_qs.exists())
+
     def test_update_children_create_list(self):
         m = DemoModelFactory(name="Old", document="test.txt")
         child_qs = DemoChildModel.objects.filter(parent=m)
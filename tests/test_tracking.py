@@ -0,0 +1,104 @@
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+import pytest
+from unittest import TestCase
+
+from etools_validator.utils import check_editable_fields, check_rigid_fields
+
+from demo.factories import DemoModelFactory, UserFactory
+from demo.sample.models import DemoModel, TrackedDemoModel
+from demo.sample.validations import TrackedNameValidation
+
+pytestmark = pytest.mark.django_db
+
+
+class TestChangeTrackingMixin(TestCase):
+    def setUp(self):
+        self.pk = DemoModelFactory(name="Old", description="Text", document="test.pdf").pk
+
+    def test_changed_fields(self):
+        m = TrackedDemoModel.objects.get(pk=self.pk)
+        self.assertEqual(m.changed_fields(), [])
+        m.name = "New"
+        m.document = "other.pdf"
+        self.assertCountEqual(m.changed_fields(), ["name", "document"])
+        m.name = "Old"
+        self.assertEqual(m.changed_fields(), ["document"])
+
+    def test_changed_fields_not_loaded(self):
+        m = TrackedDemoModel(name="New")
+        self.assertFalse(m.has_initial_values())
+        self.assertIn("name", m.changed_fields())
+        self.assertIsNone(m.get_old_instance())
+
+    def test_changed_fields_deferred(self):
+        m = TrackedDemoModel.objects.only("name").get(pk=self.pk)
+        m.name = "New"
+        self.assertEqual(m.changed_fields(), ["name"])
+
+    def test_save_resets(self):
+        m = TrackedDemoModel.objects.get(pk=self.pk)
+        m.name = "New"
+        m.save()
+        self.assertEqual(m.changed_fields(), [])
+        self.assertEqual(m.get_old_instance().name, "New")
+
+    def test_save_update_fields(self):
+        m = TrackedDemoModel.objects.get(pk=self.pk)
+        m.name = "New"
+        m.description = "Changed"
+        m.save(update_fields=["name"])
+        self.assertEqual(m.changed_fields(), ["description"])
+
+    def test_old_instance(self):
+        m = TrackedDemoModel.objects.get(pk=self.pk)
+        m.name = "New"
+        m.document = "other.pdf"
+        with CaptureQueriesContext(connection) as queries:
+            old = m.get_old_instance()
+        self.assertEqual(len(queries), 0)
+        self.assertIsInstance(old, TrackedDemoModel)
+        self.assertEqual(old.pk, self.pk)
+        self.assertEqual(old.name, "Old")
+        self.assertEqual(old.document.name, "test.pdf")
+        self.assertIs(old.document.instance, old)
+        self.assertFalse(old._state.adding)
+        self.assertEqual(m.name, "New")
+
+    def test_checks_accept_old_instance(self):
+        m = TrackedDemoModel.objects.get(pk=self.pk)
+        m.name = "New"
+        m.old_instance = m.get_old_instance()
+        self.assertEqual(check_rigid_fields(m, ["description"]), (True, None))
+        self.assertEqual(check_rigid_fields(m, ["name"]), (False, "name"))
+        self.assertEqual(check_editable_fields(m, ["name"]), (False, "name"))
+
+
+class TestTrackedOldInstance(TestCase):
+    def setUp(self):
+        self.user = UserFactory(is_staff=True)
+        self.pk = DemoModelFactory(name="Old", document="test.pdf").pk
+
+    def test_valid(self):
+        m = TrackedDemoModel.objects.get(pk=self.pk)
+        m.description = "New"
+        with CaptureQueriesContext(connection) as queries:
+            validator = TrackedNameValidation(m, user=self.user)
+            self.assertTrue(validator.is_valid, validator.errors)
+        # only the auto transition save, the old instance is not fetched
+        self.assertEqual([query["sql"].split()[0] for query in queries.captured_queries], ["UPDATE"])
+        self.assertEqual(validator.old.name, "Old")
+
+    def test_rigid_field(self):
+        m = TrackedDemoModel.objects.get(pk=self.pk)
+        m.name = "New"
+        validator = TrackedNameValidation(m, user=self.user)
+        self.assertFalse(validator.is_valid)
+        self.assertEqual(validator.errors, ["Cannot change fields while in new: name"])
+
+    def test_not_tracked_without_old(self):
+        m = DemoModel.objects.get(pk=self.pk)
+        m.name = "New"
+        validator = TrackedNameValidation(m, user=self.user)
+        self.assertIsNone(validator.old)
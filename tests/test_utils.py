@@ -1,9 +1,14 @@
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
 import pytest
 from unittest import TestCase
+from unittest.mock import patch
 
 from etools_validator import utils
+from etools_validator.comparators import get_field_comparator
 
-from demo.factories import DemoChildModelFactory, DemoModelFactory
+from demo.factories import DemoChildModelFactory, DemoModelFactory, ManyModelFactory, SpecialModelFactory
 from demo.sample import models
 
 pytestmark = pytest.mark.django_db
@@ -20,6 +25,7 @@ class TestGetAllFieldNames(TestCase):
             "document",
             "status",
             "children",
+            "attachments",
             "demomodelnoauto",
             "special",
             "others",
@@ -31,10 +37,37 @@ class TestGetAllFieldNames(TestCase):
         self.assertCountEqual(fields, [
             "id",
             "name",
+            "data",
             "parent",
             "parent_id",
         ])
 
+    def test_cached(self):
+        fields = utils.get_all_field_names(models.DemoChildModel)
+        self.assertIn(models.DemoChildModel, utils._field_names_cache)
+        fields.append("extra")
+        self.assertNotIn("extra", utils.get_all_field_names(models.DemoChildModel()))
+
+    def test_cache_cleared_on_class_prepared(self):
+        utils.get_all_field_names(models.DemoChildModel)
+        utils._clear_field_caches(sender=models.DemoChildModel)
+        self.assertNotIn(models.DemoChildModel, utils._field_names_cache)
+
+
+class TestGetRigidComparators(TestCase):
+    def test_comparators(self):
+        comparators = dict(utils.get_rigid_comparators(models.DemoModel()))
+        self.assertCountEqual(comparators.keys(), utils.get_all_field_names(models.DemoModel))
+        self.assertIs(
+            comparators["document"],
+            get_field_comparator(models.DemoModel._meta.get_field("document")),
+        )
+        self.assertIs(comparators["children"], utils.field_comparison)
+        self.assertIs(
+            utils.get_rigid_comparators(models.DemoModel),
+            utils.get_rigid_comparators(models.DemoModel),
+        )
+
 
 class TestCheckEditableFields(TestCase):
     def test_no_old_instance(self):
@@ -110,6 +143,53 @@ class TestCheckRequiredFields(TestCase):
         self.assertEqual(field, "parent")
 
 
+class TestCheckRequiredFieldsRelated(TestCase):
+    def test_related(self):
+        m = DemoModelFactory(name="Name")
+        DemoChildModelFactory(parent=m)
+        with CaptureQueriesContext(connection) as ctx:
+            required, field = utils.check_required_fields(m, ["name", "children", "others"])
+        self.assertEqual(len(ctx.captured_queries), 1)
+        self.assertFalse(required)
+        self.assertEqual(field, ["others"])
+
+    def test_related_all(self):
+        m = DemoModelFactory(name="Name")
+        DemoChildModelFactory(parent=m)
+        m.others.add(ManyModelFactory())
+        self.assertEqual(utils.check_required_fields(m, ["children", "others"]), (True, None))
+
+    def test_one_to_one_missing(self):
+        m = DemoModelFactory(name="Name")
+        self.assertEqual(utils.check_required_fields(m, ["children", "special"]), (False, "special"))
+
+
+class TestGetRelations(TestCase):
+    def test_relations(self):
+        relations = utils.get_relations(models.DemoModel)
+        self.assertEqual(relations["children"], (models.DemoChildModel, "parent", "id", True))
+        self.assertEqual(relations["special"], (models.SpecialModel, "demo", "id", False))
+        self.assertEqual(relations["others"], (models.ManyModel, "demomodel", "pk", True))
+        self.assertNotIn("name", relations)
+
+
+class TestGetMissingRequiredFields(TestCase):
+    def test_missing(self):
+        complete = DemoModelFactory(name="Complete", document="test.pdf")
+        DemoChildModelFactory(parent=complete)
+        SpecialModelFactory(demo=complete)
+        incomplete = DemoModelFactory(name="Incomplete")
+        child = DemoChildModelFactory(parent=incomplete)
+        qs = models.DemoModel.objects.filter(pk__in=[complete.pk, incomplete.pk])
+        with CaptureQueriesContext(connection) as ctx:
+            missing = utils.get_missing_required_fields(qs, ["name", "document", "children", "special"])
+        self.assertEqual(len(ctx.captured_queries), 1)
+        self.assertEqual(missing, {incomplete.pk: ["document", "special"]})
+
+        child_qs = models.DemoChildModel.objects.filter(pk=child.pk)
+        self.assertEqual(utils.get_missing_required_fields(child_qs, ["parent", "name"]), {})
+
+
 class TestFieldComparison(TestCase):
     def test_simple(self):
         self.assertTrue(utils.field_comparison("1", "1"))
@@ -194,6 +274,144 @@ class TestCheckRigidRelated(TestCase):
         self.assertTrue(utils.check_rigid_related(parent2, "children"))
 
 
+class TestCheckRigidRelatedConcreteOnly(TestCase):
+    def setUp(self):
+        self.parent = DemoModelFactory(name="parent")
+        for i in range(30):
+            DemoChildModelFactory(name="child {}".format(i), parent=self.parent)
+        # rows loaded without the parent cached, as from a queryset
+        self.parent.children_old = list(models.DemoChildModel.objects.filter(parent=self.parent))
+        self.new = models.DemoModel.objects.get(pk=self.parent.pk)
+        self.new.old_instance = self.parent
+
+    def test_no_extra_queries(self):
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertTrue(utils.check_rigid_related(self.new, "children", concrete_only=True))
+        self.assertEqual(len(ctx.captured_queries), 1)
+
+    def test_changed(self):
+        child = self.parent.children_old[0]
+        models.DemoChildModel.objects.filter(pk=child.pk).update(name="changed")
+        self.assertFalse(utils.check_rigid_related(self.new, "children", concrete_only=True))
+
+    def test_parent_changed(self):
+        other = DemoModelFactory(name="other")
+        self.parent.children_old[0].parent_id = other.pk
+        self.assertFalse(utils.check_rigid_related(self.new, "children", concrete_only=True))
+
+    def test_deep_fields(self):
+        self.assertTrue(utils.check_rigid_related(
+            self.new,
+            "children",
+            concrete_only=True,
+            deep_fields=["parent"],
+        ))
+
+
+class TestCheckRigidModelInstanceConcreteOnly(TestCase):
+    def test_different_model(self):
+        self.assertFalse(utils.check_rigid_model_instance(
+            models.DemoModel(pk=1),
+            models.DemoChildModel(pk=1),
+            concrete_only=True,
+        ))
+
+    def test_values(self):
+        self.assertTrue(utils.check_rigid_model_instance(
+            models.DemoModel(pk=1, name="name"),
+            models.DemoModel(pk=1, name="name"),
+            concrete_only=True,
+        ))
+        self.assertFalse(utils.check_rigid_model_instance(
+            models.DemoModel(pk=1, name="name"),
+            models.DemoModel(pk=1, name="other"),
+            concrete_only=True,
+        ))
+
+
+class TestRelatedFingerprints(TestCase):
+    def setUp(self):
+        self.parent = DemoModelFactory(name="parent")
+        self.child = DemoChildModelFactory(name="child", parent=self.parent)
+        DemoChildModelFactory(name="child 2", parent=self.parent)
+        self.parent.children_old = utils.get_related_fingerprints(self.parent.children.all())
+        self.new = models.DemoModel.objects.get(pk=self.parent.pk)
+        self.new.old_instance = self.parent
+
+    def test_fingerprints(self):
+        fingerprints = self.parent.children_old
+        self.assertIsInstance(fingerprints, utils.RelatedFingerprints)
+        self.assertCountEqual([pk for pk, _ in fingerprints], self.parent.children.values_list("pk", flat=True))
+
+    def test_unchanged(self):
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertTrue(utils.check_rigid_related(self.new, "children"))
+        self.assertEqual(len(ctx.captured_queries), 1)
+
+    def test_changed(self):
+        self.child.name = "changed"
+        self.child.save()
+        self.assertFalse(utils.check_rigid_related(self.new, "children"))
+
+    def test_added(self):
+        DemoChildModelFactory(name="child 3", parent=self.parent)
+        self.assertFalse(utils.check_rigid_related(self.new, "children"))
+
+    def test_json_values(self):
+        self.child.data = {"b": [1, 2], "a": {"c": None}}
+        self.child.save()
+        fingerprints = utils.get_related_fingerprints(self.parent.children.all())
+        self.assertEqual(fingerprints, utils.get_related_fingerprints(self.parent.children.all()))
+        self.parent.children_old = fingerprints
+        self.assertTrue(utils.check_rigid_related(self.new, "children"))
+        self.child.data = {"b": [1, 3], "a": {"c": None}}
+        self.child.save()
+        self.assertFalse(utils.check_rigid_related(self.new, "children"))
+
+
+class TestRelatedChecksum(TestCase):
+    def setUp(self):
+        self.parent = DemoModelFactory(name="parent")
+        self.child = DemoChildModelFactory(name="child", parent=self.parent)
+        DemoChildModelFactory(name="child 2", parent=self.parent)
+        self.parent.children_old = utils.get_related_checksum(self.parent.children.all())
+        self.new = models.DemoModel.objects.get(pk=self.parent.pk)
+        self.new.old_instance = self.parent
+
+    def test_checksum(self):
+        checksum = self.parent.children_old
+        self.assertIsInstance(checksum, utils.RelatedChecksum)
+        self.assertEqual(checksum.count, 2)
+        self.assertEqual(
+            checksum,
+            utils.get_related_checksum(models.DemoChildModel.objects.filter(parent=self.parent).order_by("-pk")),
+        )
+
+    def test_empty(self):
+        other = DemoModelFactory()
+        self.assertEqual(utils.get_related_checksum(other.children.all()), (0, 0))
+
+    def test_unsupported_database(self):
+        with patch.object(connection, "vendor", "oracle"):
+            self.assertIsNone(utils.get_related_checksum(self.parent.children.all()))
+
+    def test_unchanged(self):
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertTrue(utils.check_rigid_related(self.new, "children"))
+        self.assertEqual(len(ctx.captured_queries), 1)
+
+    def test_changed(self):
+        self.child.name = "changed"
+        self.child.save()
+        self.assertFalse(utils.check_rigid_related(self.new, "children"))
+
+    def test_null_changed(self):
+        m = DemoModelFactory(document="")
+        m.others_old = utils.get_related_checksum(models.DemoModel.objects.filter(pk=m.pk))
+        models.DemoModel.objects.filter(pk=m.pk).update(document=None)
+        self.assertNotEqual(m.others_old, utils.get_related_checksum(models.DemoModel.objects.filter(pk=m.pk)))
+
+
 class TestCheckRigidFields(TestCase):
     def test_no_old_instance(self):
         obj = models.DemoModel(name="Object")
@@ -236,6 +454,23 @@ class TestCheckRigidFields(TestCase):
             (False, "parent")
         )
 
+    def test_foreign_key_concrete_only(self):
+        parent = DemoModelFactory()
+        old = DemoChildModelFactory(name="Old", parent=parent)
+        new = models.DemoChildModel.objects.get(pk=old.pk)
+        new.old_instance = old
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertEqual(
+                utils.check_rigid_fields(new, ["parent"], concrete_only=True),
+                (True, None)
+            )
+        self.assertEqual(len(ctx.captured_queries), 0)
+        new.parent = DemoModelFactory()
+        self.assertEqual(
+            utils.check_rigid_fields(new, ["parent"], concrete_only=True),
+            (False, "parent")
+        )
+
     def test_field_does_not_exist(self):
         old = models.DemoChildModel(name="Old")
         new = models.DemoChildModel(name="New")
@@ -288,6 +523,146 @@ class TestCheckRigidFields(TestCase):
         )
 
 
+class TestCheckRigidFieldsInDb(TestCase):
+    def test_not_saved(self):
+        m = models.DemoModel(name="New")
+        self.assertEqual(utils.check_rigid_fields_in_db(m, ["name"]), (True, None))
+
+    def test_unchanged(self):
+        parent = DemoModelFactory()
+        child = DemoChildModelFactory(name="Child", parent=parent)
+        child = models.DemoChildModel.objects.get(pk=child.pk)
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertEqual(
+                utils.check_rigid_fields_in_db(child, ["name", "parent"]),
+                (True, None)
+            )
+        self.assertEqual(len(ctx.captured_queries), 1)
+
+    def test_changed(self):
+        m = DemoModelFactory(name="Old", document="test.pdf")
+        m.description = None
+        m.document = "other.pdf"
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertEqual(
+                utils.check_rigid_fields_in_db(m, ["name", "document", "description"]),
+                (False, "document")
+            )
+        self.assertEqual(len(ctx.captured_queries), 2)
+
+    def test_foreign_key_changed(self):
+        child = DemoChildModelFactory(name="Child")
+        child.parent = DemoModelFactory()
+        self.assertEqual(
+            utils.check_rigid_fields_in_db(child, ["name", "parent"]),
+            (False, "parent")
+        )
+
+    def test_not_scalar(self):
+        m = DemoModelFactory()
+        with self.assertRaisesRegex(ValueError, "not a scalar field"):
+            utils.check_rigid_fields_in_db(m, ["others"])
+
+
+class TestChangeset(TestCase):
+    def test_no_old(self):
+        changeset = utils.Changeset(models.DemoModel(name="New"), None)
+        self.assertTrue(changeset.has_changed("name"))
+
+    def test_scalar(self):
+        old = DemoModelFactory(name="Old", description="Same", document="test.pdf")
+        new = models.DemoModel.objects.get(pk=old.pk)
+        new.name = "New"
+        changeset = utils.Changeset(new, old)
+        self.assertTrue(changeset.has_changed("name"))
+        self.assertFalse(changeset.has_changed("description"))
+        self.assertFalse(changeset.has_changed("document"))
+        self.assertIn("name", changeset)
+        self.assertEqual(changeset.get_changed_fields(), ["name"])
+        self.assertEqual(changeset.kind("document"), utils.Changeset.FILE)
+
+    def test_cached(self):
+        old = DemoModelFactory(name="Old")
+        new = models.DemoModel.objects.get(pk=old.pk)
+        changeset = utils.Changeset(new, old)
+        self.assertFalse(changeset.has_changed("name"))
+        new.name = "New"
+        self.assertFalse(changeset.has_changed("name"))
+        changeset.clear()
+        self.assertTrue(changeset.has_changed("name"))
+
+    def test_foreign_key(self):
+        old = DemoChildModelFactory(name="Child")
+        new = models.DemoChildModel.objects.get(pk=old.pk)
+        changeset = utils.Changeset(new, old)
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertFalse(changeset.has_changed("parent"))
+            self.assertFalse(changeset.has_changed("parent_id"))
+        self.assertEqual(len(ctx.captured_queries), 0)
+        new.parent = DemoModelFactory()
+        changeset.clear()
+        self.assertTrue(changeset.has_changed("parent"))
+
+    def test_related(self):
+        old = DemoModelFactory(name="Old")
+        DemoChildModelFactory(parent=old)
+        new = models.DemoModel.objects.get(pk=old.pk)
+        changeset = utils.Changeset(new, old)
+        self.assertFalse(changeset.has_changed("children"))
+        old.children_old = []
+        changeset.clear()
+        self.assertTrue(changeset.has_changed("children"))
+
+    def test_one_to_one(self):
+        old = DemoModelFactory(name="Old")
+        new = models.DemoModel.objects.get(pk=old.pk)
+        changeset = utils.Changeset(new, old)
+        self.assertFalse(changeset.has_changed("special"))
+
+    def test_get_changeset(self):
+        old = DemoModelFactory(name="Old")
+        new = models.DemoModel.objects.get(pk=old.pk)
+        new.old_instance = old
+        changeset = utils.get_changeset(new)
+        self.assertIs(changeset.old, old)
+        new._changeset = changeset
+        self.assertIs(utils.get_changeset(new), changeset)
+        self.assertIsNot(utils.get_changeset(new, DemoModelFactory()), changeset)
+
+
+class TestSnapshotInstance(TestCase):
+    def test_snapshot(self):
+        parent = DemoModelFactory(name="Parent", document="test.pdf")
+        child = DemoChildModelFactory(name="Child", parent=parent)
+        child = models.DemoChildModel.objects.select_related("parent").get(pk=child.pk)
+        child.children_old = []
+        snapshot = utils.snapshot_instance(child)
+        self.assertEqual(snapshot, child)
+        self.assertEqual(snapshot.name, "Child")
+        self.assertIsNot(snapshot._state, child._state)
+        self.assertIs(snapshot.parent, child.parent)
+        self.assertFalse(hasattr(snapshot, "children_old"))
+        snapshot.name = "Snapshot"
+        snapshot.parent = DemoModelFactory(name="Other")
+        self.assertEqual(child.name, "Child")
+        self.assertEqual(child.parent, parent)
+
+    def test_snapshot_file(self):
+        m = DemoModelFactory(name="Old", document="test.pdf")
+        self.assertEqual(m.document.name, "test.pdf")
+        snapshot = utils.snapshot_instance(m)
+        self.assertIs(snapshot.document.instance, snapshot)
+        snapshot.document = "other.pdf"
+        self.assertEqual(m.document.name, "test.pdf")
+
+    def test_snapshot_deferred(self):
+        m = DemoModelFactory(name="Old")
+        m = models.DemoModel.objects.only("id").get(pk=m.pk)
+        snapshot = utils.snapshot_instance(m)
+        self.assertNotIn("name", snapshot.__dict__)
+        self.assertEqual(snapshot.name, "Old")
+
+
 class TestUpdateObject(TestCase):
     def test_update(self):
         m = models.DemoModel(name="Old")
@@ -1,12 +1,19 @@
 from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from asgiref.sync import async_to_sync
 
 import pytest
 from unittest import TestCase
+from unittest.mock import patch
 
-from etools_validator.exceptions import TransitionError
-from etools_validator.validation import CompleteValidation
+from etools_validator.exceptions import StateValidationError, TransitionError
+from etools_validator.utils import get_changeset
+from etools_validator.validation import CompleteValidation, get_fsm_transition_index
 
-from demo.factories import DemoModelFactory, PermissionFactory, UserFactory
+from demo.factories import DemoChildModelFactory, DemoModelFactory, PermissionFactory, UserFactory
 from demo.sample.models import DemoModel, DemoModelNoAuto
 from demo.sample.permissions import DemoModelPermissions
 from demo.sample.validations import DemoModelValidation
@@ -69,6 +76,25 @@ class TestCompleteValidation(TestCase):
         self.assertEqual(v.new.name, "New")
         self.assertEqual(v.old.name, "Old")
 
+    def test_init_new_dict_with_id_single_fetch(self):
+        class SingleFetchValidation(DemoModelValidation):
+            SINGLE_FETCH = True
+
+        m = DemoModelFactory(name="Old")
+        with CaptureQueriesContext(connection) as ctx:
+            v = SingleFetchValidation({"name": "New", "id": m.pk}, stateless=True)
+        self.assertEqual(len(ctx.captured_queries), 1)
+        self.assertIsNot(v.new, v.old)
+        self.assertEqual(v.new, m)
+        self.assertEqual(v.new.name, "New")
+        self.assertEqual(v.old.name, "Old")
+
+        with CaptureQueriesContext(connection) as ctx:
+            v = SingleFetchValidation({"name": "New", "id": m.pk}, old=m, stateless=True)
+        self.assertEqual(len(ctx.captured_queries), 0)
+        self.assertIs(v.old, m)
+        self.assertEqual(m.name, "Old")
+
     def test_init_new_dict_with_id_no_instance_class(self):
         """New in dictionary format, old provide, not instance_class
         ensure new and old attributes set correctly
@@ -151,6 +177,55 @@ class TestCompleteValidation(TestCase):
             }
         })
 
+    def test_get_permissions_memoized(self):
+        m = DemoModelFactory(name="Old")
+        v = DemoModelValidation({"name": "New"}, old=m)
+        v.PERMISSIONS_CLASS = DemoModelPermissions
+        with patch.object(
+                DemoModelPermissions,
+                "get_permissions",
+                return_value={"edit": {}},
+        ) as mock_get:
+            v.get_permissions(v.new)
+            v.get_permissions(v.new)
+            self.assertEqual(mock_get.call_count, 1)
+            v.new.status = DemoModel.STATUS_PENDING
+            v.get_permissions(v.new)
+            self.assertEqual(mock_get.call_count, 2)
+
+    def test_get_permissions_shared_cache(self):
+        class CachedValidation(DemoModelValidation):
+            PERMISSIONS_CLASS = DemoModelPermissions
+            PERMISSIONS_CACHE = "default"
+
+        cache.clear()
+        user = UserFactory()
+        m = DemoModelFactory(name="Old")
+        with patch.object(
+                DemoModelPermissions,
+                "get_permissions",
+                return_value={"edit": {}},
+        ) as mock_get:
+            for i in range(2):
+                v = CachedValidation({"name": "New"}, old=m, user=user)
+                self.assertEqual(v.get_permissions(v.new), {"edit": {}})
+            self.assertEqual(mock_get.call_count, 1)
+
+            v = CachedValidation({"name": "New"}, old=m, user=UserFactory(is_staff=True))
+            v.get_permissions(v.new)
+            self.assertEqual(mock_get.call_count, 2)
+
+            CachedValidation.PERMISSIONS_CACHE_VERSION = 2
+            v = CachedValidation({"name": "New"}, old=m, user=user)
+            v.get_permissions(v.new)
+            self.assertEqual(mock_get.call_count, 3)
+
+    def test_permissions_cache_key(self):
+        v = DemoModelValidation({"name": "New"}, instance_class=DemoModel)
+        key = v.get_permissions_cache_key(v.new)
+        self.assertTrue(key.startswith("etools_validator:permissions:sample.demomodel:new:"))
+        self.assertEqual(v.get_user_role_fingerprint(), "anonymous")
+
     def test_check_transition_conditions_empty(self):
         v = DemoModelValidation({"name": "New"}, instance_class=DemoModel)
         self.assertTrue(v.check_transition_conditions(None))
@@ -188,6 +263,13 @@ class TestCompleteValidation(TestCase):
             m.complete.__name__,
         )
 
+    def test_fsm_transition_index(self):
+        index = get_fsm_transition_index(DemoModel)
+        self.assertEqual(index[(DemoModel.STATUS_NEW, DemoModel.STATUS_END)], "complete")
+        self.assertEqual(index[(DemoModel.STATUS_NEW, DemoModel.STATUS_PENDING)], "pend")
+        self.assertNotIn((DemoModel.STATUS_END, DemoModel.STATUS_PENDING), index)
+        self.assertIs(get_fsm_transition_index(DemoModel), index)
+
     def test_check_transition_permission_empty(self):
         v = DemoModelValidation({"name": "New"}, instance_class=DemoModel)
         self.assertTrue(v.check_transition_permission(None))
@@ -342,6 +424,139 @@ class TestCompleteValidation(TestCase):
         )
         self.assertFalse(v.make_auto_transitions())
 
+    def test_validation_plan(self):
+        plan = DemoModelValidation.get_validation_plan()
+        self.assertIs(plan, DemoModelValidation._validation_plan)
+        self.assertEqual(plan.basic_validations, tuple(DemoModelValidation.BASIC_VALIDATIONS))
+        self.assertEqual(
+            plan.state_validators,
+            {"pending": "state_pending_valid"},
+        )
+        self.assertEqual(plan.get_state_validator_name("end"), "state_end_valid")
+        model_plan = plan.get_model_plan(DemoModel)
+        self.assertEqual(model_plan.auto_transitions, {
+            DemoModel.STATUS_NEW: (DemoModel.STATUS_PENDING, DemoModel.STATUS_END),
+            DemoModel.STATUS_PENDING: (DemoModel.STATUS_END, ),
+        })
+        self.assertEqual(plan.get_model_plan(DemoModelNoAuto).auto_transitions, {})
+        self.assertIs(plan.get_model_plan(DemoModel), model_plan)
+
+    def test_validation_plan_subclass(self):
+        class TestValidation(DemoModelValidation):
+            BASIC_VALIDATIONS = []
+
+            def state_end_valid(self, instance, user=None):
+                return True
+
+        plan = TestValidation.get_validation_plan()
+        self.assertIsNot(plan, DemoModelValidation.get_validation_plan())
+        self.assertEqual(plan.wrapped_basic_validations, ())
+        self.assertCountEqual(plan.state_validators.keys(), ["pending", "end"])
+
+    def test_state_valid_staticmethod(self):
+        class StaticValidation(DemoModelValidation):
+            @staticmethod
+            def state_new_valid(instance, user=None):
+                raise StateValidationError(["static"])
+
+        v = StaticValidation(DemoModel(name="New", document="test.pdf"))
+        self.assertEqual(v.state_valid(), (False, ["static"]))
+
+    def test_state_valid_overridden_on_instance(self):
+        v = DemoModelValidation(DemoModel(name="New", document="test.pdf"))
+        v.state_new_valid = lambda instance, user=None: False
+        self.assertEqual(v.state_valid(), (False, ["generic_state_validation_fail"]))
+
+    def test_state_valid_patched(self):
+        v = DemoModelValidation(DemoModel(name="New", document="test.pdf", status=DemoModel.STATUS_PENDING))
+        with patch.object(DemoModelValidation, "state_pending_valid", return_value=True) as state_mock:
+            self.assertEqual(v.state_valid(), (True, []))
+        state_mock.assert_called_once_with(v.new, user=None)
+
+    def test_validate_many(self):
+        def children_validation(instance):
+            return len(instance.children.all()) > 0
+
+        class ChildrenValidation(DemoModelValidation):
+            BASIC_VALIDATIONS = [children_validation]
+            PREFETCH_RELATED = ["children"]
+
+        DemoModel.objects.all().delete()
+        for i in range(5):
+            m = DemoModelFactory(name="Demo {}".format(i))
+            if i % 2:
+                DemoChildModelFactory(name="Child", parent=m)
+
+        with CaptureQueriesContext(connection) as ctx:
+            results = list(ChildrenValidation.validate_many(
+                DemoModel.objects.all(),
+                chunk_size=2,
+                stateless=True,
+            ))
+        # 3 chunks with prefetch, the last one is short so no empty chunk query
+        self.assertEqual(len(ctx.captured_queries), 6)
+        self.assertEqual(
+            [(instance.name, valid, errors) for instance, valid, errors in results],
+            [
+                ("Demo 0", False, ["children_validation"]),
+                ("Demo 1", True, []),
+                ("Demo 2", False, ["children_validation"]),
+                ("Demo 3", True, []),
+                ("Demo 4", False, ["children_validation"]),
+            ]
+        )
+
+    def test_validate_many_full_chunks(self):
+        DemoModel.objects.all().delete()
+        for i in range(4):
+            DemoModelFactory(name="Demo {}".format(i))
+        with CaptureQueriesContext(connection) as ctx:
+            results = list(DemoModelValidation.validate_many(DemoModel.objects.all(), chunk_size=2, stateless=True))
+        self.assertEqual(len(results), 4)
+        # 2 full chunks and the empty chunk that shows there are no more
+        self.assertEqual(len(ctx.captured_queries), 3)
+
+    def test_validate_many_permissions(self):
+        instances = []
+
+        class InstancePermissions(DemoModelPermissions):
+            def __init__(self, instance=None, **kwargs):
+                instances.append(instance.name)
+
+        class InstancePermissionsValidation(DemoModelValidation):
+            PERMISSIONS_CLASS = InstancePermissions
+
+        DemoModel.objects.all().delete()
+        for i in range(3):
+            DemoModelFactory(name="Demo {}".format(i), document="test.pdf", status=DemoModel.STATUS_END)
+
+        list(InstancePermissionsValidation.validate_many(DemoModel.objects.all()))
+        self.assertEqual(instances, ["Demo 0", "Demo 1", "Demo 2"])
+
+        del instances[:]
+        list(InstancePermissionsValidation.validate_many(DemoModel.objects.all(), share_permissions=True))
+        self.assertEqual(instances, ["Demo 0"])
+
+    def test_changeset(self):
+        changesets = []
+
+        class ChangesetValidation(DemoModelValidation):
+            BASIC_VALIDATIONS = []
+
+            def state_new_valid(self, instance, user=None):
+                changesets.append(get_changeset(instance))
+                return not self.changeset.has_changed("description")
+
+        m = DemoModelFactory(name="Old")
+        v = ChangesetValidation({"id": m.pk, "name": "New"}, old=m)
+        self.assertTrue(v.state_valid()[0])
+        self.assertEqual(changesets, [v.changeset])
+        self.assertEqual(v.changeset.get_changed_fields(), ["name"])
+        self.assertFalse(hasattr(v.new, "_changeset"))
+
+        v = ChangesetValidation({"id": m.pk, "description": "New"}, old=m)
+        self.assertFalse(v.state_valid()[0])
+
     def test_map_errors(self):
         v = DemoModelValidation({"name": "New"}, instance_class=DemoModel)
         self.assertEqual(v.map_errors(["wrong"]), ["Things went wrong"])
@@ -382,6 +597,18 @@ class TestCompleteValidation(TestCase):
         v.BASIC_VALIDATIONS = []
         self.assertTrue(v.is_valid)
 
+    def test_ais_valid(self):
+        user = UserFactory()
+        v = DemoModelValidation({"name": "New"}, user=user, instance_class=DemoModel)
+        v.BASIC_VALIDATIONS = []
+        self.assertTrue(async_to_sync(v.ais_valid)())
+        self.assertEqual(async_to_sync(v.aerrors)(), [])
+
+    def test_aerrors(self):
+        v = DemoModelValidation({"name": "New"}, instance_class=DemoModel)
+        self.assertEqual(async_to_sync(v.aerrors)(), ["demo_validation"])
+        self.assertFalse(async_to_sync(v.ais_valid)())
+
     def test_errors(self):
         v = DemoModelValidation({"name": "New"}, instance_class=DemoModel)
         self.assertEqual(v.errors, ["demo_validation"])